@@ -0,0 +1,190 @@
+#!/usr/bin/python
+"""bench_draw.py Draw benchmark of the pvrtask stimuli by Simon Schwab"""
+# Copyright (C) 2010-2012 Simon Schwab
+# Department of Psychiatric Neurophysiology, University of Bern.
+#
+# Distributed under the terms of the GNU General Public License (GPL).
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Times construction, first draw and steady-state draw of each stimulus
+# class, with glFinish() after every draw so the GPU work is included.
+# The results can be saved as a baseline (JSON) and later compared
+# against it; a case fails if it got slower than the baseline by more
+# than the threshold. Without a display, run it on software OpenGL:
+#
+# $ xvfb-run -a python bench_draw.py --software --save baseline.json
+# $ xvfb-run -a python bench_draw.py --software --compare baseline.json
+
+import sys, os, time, json, ctypes, platform, optparse
+
+SOFTWARE = '--software' in sys.argv
+if SOFTWARE:
+    # Must be set before the GL library is loaded
+    os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+
+from psychopy import visual
+import pyglet.gl as GL
+
+import pvrtask
+from pvrtask import resources, Experiment, Color, Orientation, Position, \
+                    SquareStim, LandoltStim, LandoltStimSmall, SwordStim, \
+                    Point
+
+EYEHEIGHT = 170
+THRESHOLD = 0.5 # Accepted slowdown against the baseline (0.5: 50%)
+MIN_DIFFERENCE = 0.00005 # Slowdowns below 50 us are timer noise
+INSTRUCTIONS = """
+        Wenn die beiden Figuren gleich sind, druecken Sie mit dem
+        Zeigefinger. Wenn die beiden Figuren eine verschiedene
+        Farbe haben, oder eine unterschiedliche Orientierung, dann
+        druecken sie mit dem Mittelfinger.
+        """
+
+# Name and constructor of each benchmarked stimulus
+CASES = [
+    ('SquareStim', lambda win: SquareStim(Color("red"),
+                                          Position("left", EYEHEIGHT), win)),
+    ('LandoltStim', lambda win: LandoltStim(Orientation("up"),
+                                            Position("left", EYEHEIGHT),
+                                            win)),
+    ('LandoltStimSmall', lambda win: LandoltStimSmall(
+        Orientation("up"), Position("left", EYEHEIGHT), win)),
+    ('SwordStim', lambda win: SwordStim(Color("white"),
+                                        Position("left", EYEHEIGHT), win,
+                                        pvrtask.Sword("i").string)),
+    ('Point', lambda win: Point(win, Position(
+        "central", EYEHEIGHT).get_fixcross_position())),
+    ('TextStim', lambda win: visual.TextStim(win, text=INSTRUCTIONS,
+                                             height=0.5, font='FreeSans'))
+    ]
+METRICS = ['construct', 'first_draw', 'draw']
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def draw_time(win, stimulus):
+    """Draws the stimulus and returns the time until the GPU is done."""
+    start = time.time()
+    stimulus.draw()
+    GL.glFinish()
+    duration = time.time() - start
+    win.clearBuffer()
+    return duration
+
+def run_case(create, repeats):
+    """Times a case in its own window, in seconds."""
+    win = resources.open_window(size=Experiment.WIN_SIZE,
+                                monitor=Experiment.MONITOR,
+                                units="deg",
+                                color=Experiment.WIN_COLOR)
+    win.flip(clearBuffer = True)
+
+    # The first instance in a fresh window pays the one-time costs
+    start = time.time()
+    stimulus = create(win)
+    first_construct = time.time() - start
+    first_draw = draw_time(win, stimulus)
+
+    construct = [first_construct]
+    for i in range(0, repeats):
+        start = time.time()
+        create(win)
+        construct.append(time.time() - start)
+    draw = [draw_time(win, stimulus) for i in range(0, repeats)]
+
+    resources.close_window(win)
+    return {'construct': median(construct),
+            'first_draw': first_draw,
+            'draw': median(draw)}
+
+def get_renderer():
+    """Gets the name of the OpenGL renderer of the current context."""
+    return ctypes.cast(GL.glGetString(GL.GL_RENDERER), ctypes.c_char_p).value
+
+def compare(results, baseline):
+    """Prints the results against the baseline, and returns the number of
+    regressions."""
+    threshold = baseline.get('threshold', THRESHOLD)
+    failed = 0
+    for name, create in CASES:
+        if name not in baseline['results']:
+            continue
+        for metric in METRICS:
+            base = baseline['results'][name][metric]
+            now = results[name][metric]
+            if base <= 0:
+                continue
+            ratio = now / base
+            status = 'ok'
+            if ratio > 1 + threshold and now - base > MIN_DIFFERENCE:
+                status = 'SLOWER'
+                failed = failed + 1
+            print '%-17s %-11s %9.3f ms %9.3f ms %6.2fx %s' % (
+                name, metric, base * 1000, now * 1000, ratio, status)
+    return failed
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--software', action='store_true', default=False,
+                      help='use Mesa software rendering (llvmpipe)')
+    parser.add_option('--repeats', type='int', default=200,
+                      help='repetitions of construction and draw')
+    parser.add_option('--save', metavar='FILE',
+                      help='save the results as baseline')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the results with a baseline')
+    parser.add_option('--threshold', type='float', default=THRESHOLD,
+                      help='accepted slowdown saved with the baseline')
+    (options, args) = parser.parse_args()
+
+    pvrtask.init_log('warning', None)
+    win = resources.open_window(size=(64, 64), monitor=Experiment.MONITOR)
+    renderer = get_renderer()
+    resources.close_window(win)
+    print 'Renderer: %s' % renderer
+
+    results = {}
+    for name, create in CASES:
+        results[name] = run_case(create, options.repeats)
+        print '%-17s construct %8.3f ms, first draw %8.3f ms, ' \
+              'draw %8.3f ms' % (name, results[name]['construct'] * 1000,
+                                 results[name]['first_draw'] * 1000,
+                                 results[name]['draw'] * 1000)
+
+    if options.save != None:
+        baseline = {'machine': platform.node(),
+                    'renderer': renderer,
+                    'threshold': options.threshold,
+                    'results': results}
+        file = open(options.save, 'w')
+        json.dump(baseline, file, indent=1, sort_keys=True)
+        file.close()
+
+    failed = 0
+    if options.compare != None:
+        baseline = json.load(open(options.compare))
+        if baseline.get('renderer') != renderer:
+            print 'Warning: baseline was taken on %s' % baseline.get(
+                'renderer')
+        failed = compare(results, baseline)
+        if failed:
+            print 'FAILED: %d regressions' % failed
+        else:
+            print 'OK'
+    pvrtask.log.stop()
+    return int(failed > 0)
+
+if __name__ == '__main__':
+    sys.exit(main())
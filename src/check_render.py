@@ -0,0 +1,226 @@
+#!/usr/bin/python
+"""check_render.py Off-screen geometry check of the pvrtask stimuli by
+Simon Schwab"""
+# Copyright (C) 2010-2012 Simon Schwab
+# Department of Psychiatric Neurophysiology, University of Bern.
+#
+# Distributed under the terms of the GNU General Public License (GPL).
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks the geometry of the stimuli without a projector. Each stimulus
+# of the stimulus sets is drawn alone into the back buffer of a window,
+# which is never flipped, and read back with glReadPixels directly into
+# a preallocated NumPy array. Bounding box and centroid of the drawn
+# pixels are compared with the position and size given by Position, and
+# a hash of the pixels can be saved as reference and compared later
+# (the hashes depend on the renderer).
+#
+# $ python check_render.py [--eyeheight 170] [--save FILE] [--compare FILE]
+# $ xvfb-run -a python check_render.py --software
+
+import sys, os, time, json, ctypes, hashlib, random, optparse
+
+if '--software' in sys.argv:
+    # Must be set before the GL library is loaded
+    os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+
+import numpy
+from psychopy import misc
+import pyglet.gl as GL
+
+import pvrtask
+from pvrtask import resources, Experiment, Stimuli, StimuliLandoltSmall, \
+                    StimuliSword, SquareStim, LandoltStim, SwordStim, Point
+
+STIMULUS_SETS = [Stimuli, StimuliLandoltSmall, StimuliSword]
+TOLERANCE_PIXELS = 2 # Accepted deviation in pixels...
+TOLERANCE_SIZE = 0.03 # ...or relative to the stimulus size, if larger
+SEED = 0 # Seed of the random sWord strings
+
+class Snapshot:
+    """Reads the back buffer of a window into a NumPy array, which is
+    allocated once and passed to glReadPixels as pointer."""
+
+    def __init__(self, win):
+        self.win = win
+        self.width, self.height = win.size
+        self.pixels = numpy.empty((self.height, self.width, 3), numpy.uint8)
+        self.pointer = self.pixels.ctypes.data_as(
+            ctypes.POINTER(ctypes.c_ubyte))
+        self.pix_per_deg = misc.deg2pix(1.0, win.monitor)
+        self.background = self.read().copy()
+
+    def read(self):
+        """Reads the back buffer, row 0 is the bottom of the window."""
+        GL.glFinish()
+        GL.glReadBuffer(GL.GL_BACK)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        GL.glReadPixels(0, 0, self.width, self.height, GL.GL_RGB,
+                        GL.GL_UNSIGNED_BYTE, self.pointer)
+        return self.pixels
+
+    def measure(self, stimulus):
+        """Draws the stimulus alone and returns bounding box (left,
+        bottom, right, top) and centroid in degrees from the window
+        center, and the hash of the pixels. None if nothing was drawn."""
+        self.win.clearBuffer()
+        stimulus.draw()
+        pixels = self.read()
+        mask = (pixels != self.background).any(axis=2)
+        self.win.clearBuffer()
+        rows, columns = numpy.nonzero(mask)
+        if len(rows) == 0:
+            return None
+        center_x = self.width / 2.0
+        center_y = self.height / 2.0
+        box = [(columns.min() - center_x) / self.pix_per_deg,
+               (rows.min() - center_y) / self.pix_per_deg,
+               (columns.max() + 1 - center_x) / self.pix_per_deg,
+               (rows.max() + 1 - center_y) / self.pix_per_deg]
+        centroid = [(columns.mean() + 0.5 - center_x) / self.pix_per_deg,
+                    (rows.mean() + 0.5 - center_y) / self.pix_per_deg]
+        return {'box': box,
+                'centroid': centroid,
+                'hash': hashlib.sha1(pixels).hexdigest()}
+
+def get_expected(stimulus):
+    """Gets the expected center and size (width, height) in degrees of a
+    stimulus. Sizes that cannot be predicted (text) are None."""
+    if isinstance(stimulus, SquareStim):
+        x, y = stimulus.position.get_square_position()
+        width = stimulus.position.get_square_width()
+        height = stimulus.position.get_square_height()
+        return [x + width / 2, y + height / 2], [width, height]
+    elif isinstance(stimulus, LandoltStim):
+        size = stimulus.height * LandoltStim.SLOAN_SCALE
+        return stimulus.position.get_landolt_position(), [size, size]
+    elif isinstance(stimulus, SwordStim):
+        return stimulus.position.get_landolt_position(), [None, None]
+    elif isinstance(stimulus, Point):
+        return list(stimulus.pos), [Point.SIZE, Point.SIZE]
+    raise ValueError('Unknown stimulus: %s' % stimulus)
+
+def check(measured, stimulus, pix_per_deg):
+    """Compares the measured geometry with the expected one. Returns a
+    list of errors."""
+    if measured == None:
+        return ['nothing drawn']
+    center, size = get_expected(stimulus)
+    left, bottom, right, top = measured['box']
+    found_center = [(left + right) / 2, (bottom + top) / 2]
+    found_size = [right - left, top - bottom]
+    errors = []
+    for axis, name in [(0, 'x'), (1, 'y')]:
+        if size[axis] == None:
+            # Text: only the horizontal center is known
+            if axis == 0:
+                tolerance = TOLERANCE_PIXELS / pix_per_deg + \
+                            TOLERANCE_SIZE * found_size[0]
+                if abs(found_center[0] - center[0]) > tolerance:
+                    errors.append('center x %.3f instead of %.3f' %
+                                  (found_center[0], center[0]))
+            continue
+        tolerance = max(TOLERANCE_PIXELS / pix_per_deg,
+                        TOLERANCE_SIZE * size[axis])
+        if abs(found_center[axis] - center[axis]) > tolerance:
+            errors.append('center %s %.3f instead of %.3f' %
+                          (name, found_center[axis], center[axis]))
+        if abs(found_size[axis] - size[axis]) > tolerance:
+            errors.append('size %s %.3f instead of %.3f' %
+                          (name, found_size[axis], size[axis]))
+    return errors
+
+def describe(stimulus):
+    """Gets a unique name of a stimulus in its set."""
+    if isinstance(stimulus, Point):
+        return 'fixation cross'
+    return '%s %s %s' % (stimulus.get_name(), stimulus.get_type(),
+                         stimulus.get_position())
+
+def check_eyeheight(win, snapshot, eyeheight, references):
+    """Checks all stimulus sets for an eye height. Returns the results by
+    name and the number of failed stimuli."""
+    results = {}
+    failed = 0
+    for stimulus_set in STIMULUS_SETS:
+        random.seed(SEED)
+        stimuli = stimulus_set(win, eyeheight)
+        for stimulus in [stimuli.get_fixation_cross()] + \
+                        stimuli.get_central_stimuli() + \
+                        stimuli.get_peripheral_stimuli():
+            name = '%s %s: %s' % (stimulus_set.__name__, eyeheight,
+                                  describe(stimulus))
+            if name in results:
+                continue
+            measured = snapshot.measure(stimulus)
+            errors = check(measured, stimulus, snapshot.pix_per_deg)
+            if (measured != None and name in references and
+                references[name]['hash'] != measured['hash']):
+                errors.append('pixels differ from the reference')
+            if errors:
+                failed = failed + 1
+                print '%s: %s' % (name, ', '.join(errors))
+            results[name] = measured
+    return results, failed
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--software', action='store_true', default=False,
+                      help='use Mesa software rendering (llvmpipe)')
+    parser.add_option('--eyeheight', type='int', action='append',
+                      help='eye height in cm (repeatable, default 150, '
+                      '170 and 190)')
+    parser.add_option('--save', metavar='FILE',
+                      help='save the measurements as reference')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the pixel hashes with a reference')
+    (options, args) = parser.parse_args()
+    eyeheights = options.eyeheight or [150, 170, 190]
+
+    pvrtask.init_log('warning', None)
+    references = {}
+    if options.compare != None:
+        references = json.load(open(options.compare))
+
+    win = resources.open_window(size=Experiment.WIN_SIZE,
+                                monitor=Experiment.MONITOR,
+                                units="deg",
+                                color=Experiment.WIN_COLOR)
+    win.clearBuffer()
+    snapshot = Snapshot(win)
+    start = time.time()
+    results = {}
+    failed = 0
+    for eyeheight in eyeheights:
+        measured, count = check_eyeheight(win, snapshot, eyeheight,
+                                          references)
+        results.update(measured)
+        failed = failed + count
+    duration = time.time() - start
+    resources.close_window(win)
+    pvrtask.log.stop()
+
+    print '%d stimuli checked in %.0f ms' % (len(results), duration * 1000)
+    if options.save != None:
+        file = open(options.save, 'w')
+        json.dump(results, file, indent=1, sort_keys=True)
+        file.close()
+    if failed:
+        print 'FAILED: %d stimuli' % failed
+        return 1
+    print 'OK'
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
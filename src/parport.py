@@ -0,0 +1,230 @@
+#!/usr/bin/python
+"""parport.py Parallel port access for pvrtask by Simon Schwab"""
+# Copyright (C) 2010-2012 Simon Schwab
+# Department of Psychiatric Neurophysiology, University of Bern.
+#
+# Distributed under the terms of the GNU General Public License (GPL).
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, time, random
+
+class ParallelPort:
+    """Base class of the parallel port backends. The data byte drives the
+    TTL lines to the eye tracker, the status byte holds the buttons of the
+    response box. Every call is timed, so each backend reports its own
+    per-call latency."""
+
+    name = None
+
+    def __init__(self):
+        self.calls = 0
+        self.call_time = 0.0
+        self.max_call_time = 0.0
+
+    def read_status(self):
+        """Reads the status byte."""
+        start = time.time()
+        status = self._read_status()
+        self.__count(time.time() - start)
+        return status
+
+    def write_data(self, value):
+        """Writes the data byte."""
+        start = time.time()
+        self._write_data(value)
+        self.__count(time.time() - start)
+
+    def __count(self, duration):
+        """Adds the duration of a call to the latency statistics."""
+        self.calls = self.calls + 1
+        self.call_time = self.call_time + duration
+        if duration > self.max_call_time:
+            self.max_call_time = duration
+
+    def get_latency(self):
+        """Gets the mean and maximum duration of a call in seconds."""
+        if self.calls == 0:
+            return [None, None]
+        return [self.call_time / self.calls, self.max_call_time]
+
+    def measure_latency(self, calls = 1000):
+        """Reads the status byte a number of times and returns the mean
+        duration of a call in seconds."""
+        start = time.time()
+        for i in range(0, calls):
+            self.read_status()
+        return (time.time() - start) / calls
+
+    def close(self):
+        """Releases the port."""
+        pass
+
+class PortioPort(ParallelPort):
+    """Direct I/O on the port addresses with the PortIO library. Needs root
+    for ioperm."""
+
+    name = "portio"
+
+    def __init__(self, base = 0x378):
+        ParallelPort.__init__(self)
+        import portio
+        self.portio = portio
+        self.data_address = base
+        self.status_address = base + 1
+
+        status_a = portio.ioperm(self.data_address, 1, 1)
+        status_b = portio.ioperm(self.status_address, 1, 1)
+        if status_a or status_b:
+            raise IOError('ioperm 0x%x: %s' % (base,
+                                               os.strerror(status_a or
+                                                           status_b)))
+
+    def _read_status(self):
+        return self.portio.inb(self.status_address)
+
+    def _write_data(self, value):
+        self.portio.outb(value, self.data_address)
+
+class PpdevPort(ParallelPort):
+    """The Linux ppdev driver (/dev/parportN) using ioctls. Works without
+    root for users with access to the device file."""
+
+    name = "ppdev"
+
+    # ioctl numbers from linux/ppdev.h
+    PPCLAIM = 0x708b
+    PPRELEASE = 0x708c
+    PPRSTATUS = 0x80017081
+    PPWDATA = 0x40017086
+
+    def __init__(self, device = "/dev/parport0"):
+        ParallelPort.__init__(self)
+        import fcntl, array, struct
+        self.fcntl = fcntl
+        self.struct = struct
+        self.buffer = array.array('B', [0])
+        self.fd = os.open(device, os.O_RDWR)
+        try:
+            fcntl.ioctl(self.fd, PpdevPort.PPCLAIM)
+        except IOError:
+            os.close(self.fd)
+            raise
+
+    def _read_status(self):
+        self.fcntl.ioctl(self.fd, PpdevPort.PPRSTATUS, self.buffer, True)
+        return self.buffer[0]
+
+    def _write_data(self, value):
+        self.fcntl.ioctl(self.fd, PpdevPort.PPWDATA,
+                         self.struct.pack('B', value))
+
+    def close(self):
+        self.fcntl.ioctl(self.fd, PpdevPort.PPRELEASE)
+        os.close(self.fd)
+
+class FakePort(ParallelPort):
+    """An in-memory port for development and testing without hardware. Each
+    call takes latency plus a random jitter (uniform, in seconds), and the
+    status byte can be set to simulate the response box."""
+
+    name = "fake"
+
+    IDLE_STATUS = 0x78 # Status byte when no button is pressed
+
+    def __init__(self, latency = 0.0, jitter = 0.0):
+        ParallelPort.__init__(self)
+        self.latency = latency
+        self.jitter = jitter
+        self.status = FakePort.IDLE_STATUS
+        self.data = 0x0
+
+    def __delay(self):
+        """Busy waits for the simulated latency of a call."""
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            end = time.time() + delay
+            while time.time() < end:
+                pass
+
+    def _read_status(self):
+        self.__delay()
+        return self.status
+
+    def _write_data(self, value):
+        self.__delay()
+        self.data = value
+
+    def set_status(self, status):
+        """Sets the status byte, e.g. to press a button."""
+        self.status = status
+
+    def release(self):
+        """Releases all buttons."""
+        self.status = FakePort.IDLE_STATUS
+
+    def get_data(self):
+        """Gets the last data byte written."""
+        return self.data
+
+BACKENDS = [PortioPort, PpdevPort, FakePort]
+
+def open_port(name, device = None):
+    """Opens the backend with the given name. The device is the base
+    address (portio, e.g. "0x378") or the device file (ppdev)."""
+    if name == "portio":
+        if device == None:
+            return PortioPort()
+        return PortioPort(int(device, 0))
+    elif name == "ppdev":
+        if device == None:
+            return PpdevPort()
+        return PpdevPort(device)
+    elif name == "fake":
+        return FakePort()
+    raise ValueError('Unknown parallel port backend: %s' % name)
+
+def open_fastest(names = ["portio", "ppdev"], calls = 1000):
+    """Opens all available backends of the given names, and returns the one
+    with the lowest latency. The others are closed again."""
+    fastest = None
+    for name in names:
+        try:
+            port = open_port(name)
+        except (ImportError, IOError, OSError):
+            continue
+        port.measure_latency(calls)
+        if fastest == None or port.get_latency()[0] < fastest.get_latency()[0]:
+            if fastest != None:
+                fastest.close()
+            fastest = port
+        else:
+            port.close()
+    if fastest == None:
+        raise IOError('No parallel port backend available.')
+    return fastest
+
+if __name__ == '__main__':
+    # Report the latency of each backend on this station
+    for backend in BACKENDS:
+        try:
+            port = backend()
+        except (ImportError, IOError, OSError), error:
+            print '%-7s not available: %s' % (backend.name, error)
+            continue
+        port.measure_latency()
+        mean, maximum = port.get_latency()
+        print '%-7s mean %.2f us, max %.2f us per call' % (backend.name,
+                                                           mean * 1e6,
+                                                           maximum * 1e6)
+        port.close()
@@ -17,21 +17,32 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from psychopy import core, visual, event
+from psychopy import core, visual, event, misc
+import pyglet.gl as GL
+import pyglet.font
+import numpy
 from Tkinter import Tk, Frame, Button, Radiobutton, Menu, Label, Entry, \
                     E, W, StringVar, mainloop, OptionMenu, END, Spinbox
 
 from tkFileDialog import asksaveasfile
 
-import time, sys, os, random, portio, datetime, tkMessageBox, tkFont, \
+import time, sys, os, random, datetime, tkMessageBox, tkFont, \
+        threading, collections, heapq, optparse, gc, array, resource, \
+        ctypes, ctypes.util, struct, select, math, Queue, hashlib, \
         string, pdb # pdb for debugger
 
+import parport
+
 class Sword:
     """A sWord is not a sword but a scrambled word, or actually
     a random character string that may contain selected characters
     or not (logical parameter match)."""
+
+    ALPHABET = ['b', 'd', 'l', 'p', 'q', 'w']
+    SELECTION = ['i', 'o', 'x', 'v'] # Characters of the central stimuli
+
     def __init__(self, match):
-        alphabet = ['b', 'd', 'l', 'p', 'q', 'w']
+        alphabet = list(Sword.ALPHABET)
         random.shuffle(alphabet)
 
         # create swords of size 5
@@ -47,6 +58,1166 @@ class Sword:
             random.shuffle(vector)
             self.string = ''.join(vector)
 
+class SwordCorpus:
+    """Generates many unique sWords at once with NumPy. A given proportion
+    of the strings contains one of the target characters (match), in equal
+    numbers and at balanced positions; the other characters are letters
+    of the alphabet, drawn with the given letter weights. The match label,
+    target and position of each string are kept, so they never have to be
+    searched in the string."""
+
+    LENGTH = 4 # Characters of a sWord
+    ATTEMPTS = 1000 # Rounds of drawing the duplicates again
+
+    def __init__(self, count, match = 0.5, targets = None, letters = None,
+                 positions = None, distinct = True, seed = None):
+        """count is the number of strings, match the proportion with a
+        target (Sword.SELECTION by default), letters are the weights of
+        the characters of Sword.ALPHABET and positions the weights of the
+        target positions (equal by default). Distinct letters, as in Sword,
+        allow 360 strings without and 480 per target with a match; with
+        repeated letters there are 1296 and 864."""
+        if targets == None:
+            targets = Sword.SELECTION
+        if letters == None:
+            letters = [1.0] * len(Sword.ALPHABET)
+        if seed == None:
+            seed = random.randrange(0, 0x7fffffff)
+        self.generator = numpy.random.RandomState(seed)
+        self.weights = numpy.asarray(letters, float)
+        self.distinct = distinct
+        self.symbols = numpy.array(Sword.ALPHABET + Sword.SELECTION, 'S1')
+
+        start = time.time()
+        # Match labels, targets and positions, balanced over the strings
+        matches = int(round(count * match))
+        self.matches = numpy.zeros(count, bool)
+        self.matches[:matches] = True
+        self.generator.shuffle(self.matches)
+        self.targets = numpy.zeros(count, numpy.uint8)
+        self.positions = numpy.zeros(count, numpy.uint8)
+        codes = numpy.array([Sword.SELECTION.index(target)
+                             for target in targets])
+        self.targets[self.matches] = len(Sword.ALPHABET) + \
+            self.generator.permutation(numpy.resize(codes, matches))
+        if positions == None:
+            position = self.generator.permutation(
+                numpy.resize(numpy.arange(SwordCorpus.LENGTH), matches))
+        else:
+            weights = numpy.asarray(positions, float)
+            position = self.generator.choice(SwordCorpus.LENGTH, matches,
+                                             p = weights / weights.sum())
+        self.positions[self.matches] = position
+
+        # Draw all strings, then the duplicates again until all differ
+        self.codes = numpy.zeros((count, SwordCorpus.LENGTH), numpy.uint8)
+        redraw = numpy.arange(count)
+        for attempt in range(0, SwordCorpus.ATTEMPTS):
+            self.__draw(redraw)
+            keys = numpy.dot(self.codes.astype(int),
+                             len(self.symbols) **
+                             numpy.arange(SwordCorpus.LENGTH))
+            unique, first = numpy.unique(keys, return_index = True)
+            if len(unique) == count:
+                break
+            duplicate = numpy.ones(count, bool)
+            duplicate[first] = False
+            redraw = numpy.nonzero(duplicate)[0]
+        else:
+            raise ValueError('Only %d unique sWords of %d' %
+                             (len(unique), count))
+
+        log.info('sWord corpus: %d strings, %d matches, %.3f ms', count,
+                 matches, (time.time() - start) * 1000)
+
+    def __draw(self, rows):
+        """Draws the strings of the given rows. Distinct letters are drawn
+        by weight (the largest of u ** (1 / weight) for uniform u), and the
+        target replaces the letter at its position."""
+        if self.distinct:
+            keys = numpy.log(self.generator.random_sample(
+                (len(rows), len(self.weights)))) / self.weights
+            letters = numpy.argsort(-keys, axis = 1)[:, :SwordCorpus.LENGTH]
+        else:
+            letters = self.generator.choice(
+                len(self.weights), (len(rows), SwordCorpus.LENGTH),
+                p = self.weights / self.weights.sum())
+        self.codes[rows] = letters
+        matched = rows[self.matches[rows]]
+        self.codes[matched, self.positions[matched]] = self.targets[matched]
+
+    def get_strings(self):
+        """Gets the strings."""
+        characters = self.symbols[self.codes]
+        return list(numpy.ascontiguousarray(characters).view(
+            'S%d' % SwordCorpus.LENGTH).ravel())
+
+    def get_matches(self):
+        """Gets the match label of each string."""
+        return list(self.matches)
+
+    def get_targets(self):
+        """Gets the target character of each string ("" without)."""
+        return [match and self.symbols[target] or ""
+                for match, target in zip(self.matches, self.targets)]
+
+    def get_positions(self):
+        """Gets the position of the target in each string (None
+        without)."""
+        positions = []
+        for match, position in zip(self.matches, self.positions):
+            if match:
+                positions.append(int(position))
+            else:
+                positions.append(None)
+        return positions
+
+class RingLog(threading.Thread):
+    """Deferred logging for the presentation thread. A message is stored
+    with its arguments in a preallocated ring buffer, without formatting
+    or writing to the terminal. A background thread, or drain() e.g. in
+    a pause, formats and writes the messages. When the buffer is full,
+    new messages are counted as dropped instead of blocking."""
+
+    ERROR = 0
+    WARNING = 1
+    INFO = 2
+    DEBUG = 3
+    LEVELS = ['ERROR', 'WARNING', 'INFO', 'DEBUG']
+
+    SIZE = 4096 # Number of messages in the ring buffer
+    DRAIN_INTERVAL = 0.5 # Seconds between two drains of the thread
+
+    def __init__(self, stream = sys.stdout, level = INFO, size = SIZE):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.stream = stream
+        self.level = level
+        self.size = size
+        self.entries = [None] * size
+        self.written = 0 # Number of messages written into the buffer
+        self.read = 0 # Number of messages drained from the buffer
+        self.dropped = 0
+        self.write_lock = threading.Lock() # only held to store a message
+        self.drain_lock = threading.Lock()
+        self.running = True
+
+    def set_output(self, stream, level):
+        """Sets the output stream and the verbosity."""
+        self.drain()
+        self.stream = stream
+        self.level = level
+
+    def log(self, level, message, *args):
+        """Stores a message, formatted later as message % args."""
+        if level > self.level:
+            return
+        self.write_lock.acquire()
+        try:
+            if self.written - self.read >= self.size:
+                self.dropped = self.dropped + 1
+            else:
+                self.entries[self.written % self.size] = (time.time(), level,
+                                                          message, args)
+                self.written = self.written + 1
+        finally:
+            self.write_lock.release()
+
+    def error(self, message, *args):
+        self.log(RingLog.ERROR, message, *args)
+
+    def warning(self, message, *args):
+        self.log(RingLog.WARNING, message, *args)
+
+    def info(self, message, *args):
+        self.log(RingLog.INFO, message, *args)
+
+    def debug(self, message, *args):
+        self.log(RingLog.DEBUG, message, *args)
+
+    def drain(self):
+        """Writes all stored messages to the output stream."""
+        self.drain_lock.acquire()
+        try:
+            lines = []
+            while self.read < self.written:
+                slot = self.read % self.size
+                stamp, level, message, args = self.entries[slot]
+                self.entries[slot] = None
+                self.read = self.read + 1
+                if len(args):
+                    message = message % args
+                lines.append('%s.%03d %s %s\n' % (
+                    time.strftime('%H:%M:%S', time.localtime(stamp)),
+                    int(stamp * 1000) % 1000, RingLog.LEVELS[level],
+                    message))
+            if self.dropped:
+                lines.append('%d log messages dropped\n' % self.dropped)
+                self.dropped = 0
+            if len(lines):
+                self.stream.writelines(lines)
+                self.stream.flush()
+        finally:
+            self.drain_lock.release()
+
+    def run(self):
+        """Drains the buffer in regular intervals."""
+        while self.running:
+            time.sleep(RingLog.DRAIN_INTERVAL)
+            self.drain()
+
+    def stop(self):
+        """Stops the thread and writes the remaining messages."""
+        self.running = False
+        self.drain()
+
+# The log of the application
+log = RingLog()
+
+class FrameTimer:
+    """Frame-locked timing for a window. Durations are converted into
+    a whole number of frames at the measured refresh rate, and phases
+    are advanced by counting flips instead of sleeping. A marker pulse
+    can be sent on the parallel port right after the buffer swap of a
+    flip, so the TTL and the logged onset describe the same instant.
+    The intervals between the flips of a trial are recorded, and
+    intervals longer than 1.5 refresh periods count as dropped frames.
+    Short tasks that need the GL context, e.g. of other threads, can be
+    deferred; one of them runs right after each flip."""
+
+    CALIBRATION_FLIPS = 60 # Number of flips to measure the refresh rate
+    TOLERANCE = 0.01 # Accepted deviation from a whole number of frames
+    DROP_THRESHOLD = 1.5 # Intervals longer than this are dropped frames
+    MAX_INTERVALS = 2048 # Size of the interval buffer of a trial
+
+    def __init__(self, window, clock, pulse_scheduler):
+        self.window = window
+        self.clock = clock
+        self.pulse_scheduler = pulse_scheduler
+        self.refresh_rate = self.__measure_refresh_rate()
+        self.frame_duration = 1.0 / self.refresh_rate
+        self.warned = []
+        self.deferred = collections.deque()
+
+        # Preallocated buffer of the flip intervals of a trial
+        self.intervals = array.array('d', [0.0] * FrameTimer.MAX_INTERVALS)
+        self.start_recording()
+
+    def __measure_refresh_rate(self):
+        """Flips the empty window a number of times and returns the
+        refresh rate in Hz, rounded to the nominal rate of the display."""
+        self.window.flip(clearBuffer = True)
+        intervals = []
+        last = time.time()
+        for i in range(0, FrameTimer.CALIBRATION_FLIPS):
+            self.window.flip(clearBuffer = True)
+            now = time.time()
+            intervals.append(now - last)
+            last = now
+
+        # The median is robust against single dropped frames.
+        intervals.sort()
+        median = intervals[len(intervals)/2]
+        return int(round(1.0 / median))
+
+    def get_frames(self, duration, name):
+        """Converts a duration in seconds into a number of frames. Warns
+        once per name if the duration is not a whole number of frames."""
+        exact = duration * self.refresh_rate
+        frames = self.round_frames(duration)
+        if (abs(exact - frames) > FrameTimer.TOLERANCE and
+            not name in self.warned):
+            log.warning('%s of %.4f s is not a whole number of frames '
+                        'at %d Hz, using %d frames (%.4f s).',
+                        name, duration, self.refresh_rate, frames,
+                        frames * self.frame_duration)
+            self.warned.append(name)
+        return frames
+
+    def round_frames(self, duration):
+        """Gets the nearest whole number of frames of a duration in
+        seconds, at least one frame."""
+        return max(int(round(duration * self.refresh_rate)), 1)
+
+    def get_refresh_rate(self):
+        """Gets the measured refresh rate in Hz."""
+        return self.refresh_rate
+
+    def flip(self, marker = None):
+        """Flips the window and returns the time of the buffer swap. The
+        marker, an unsent Pulse, is sent immediately after the swap."""
+        self.window.flip(clearBuffer = True)
+        flip_time = self.clock.getTime()
+        if marker != None:
+            self.pulse_scheduler.send(marker)
+        if self.last_flip != None:
+            self.__record(flip_time - self.last_flip)
+        self.last_flip = flip_time
+        if self.deferred:
+            self.deferred.popleft()()
+        return flip_time
+
+    def defer(self, task):
+        """Runs the task (a callable) after one of the next flips, in the
+        thread that flips the window. May be called from any thread."""
+        self.deferred.append(task)
+
+    def clear_deferred(self):
+        """Drops the tasks that have not run yet."""
+        self.deferred.clear()
+
+    def __record(self, interval):
+        """Records a flip interval and counts the dropped frames."""
+        if self.interval_count < FrameTimer.MAX_INTERVALS:
+            self.intervals[self.interval_count] = interval
+        self.interval_count = self.interval_count + 1
+        if interval > self.max_interval:
+            self.max_interval = interval
+        if interval > FrameTimer.DROP_THRESHOLD * self.frame_duration:
+            self.dropped_frames = (self.dropped_frames +
+                                   int(round(interval /
+                                             self.frame_duration)) - 1)
+
+    def start_recording(self):
+        """Starts recording the flip intervals of a new trial. The
+        interval to the last flip before is not recorded."""
+        self.last_flip = None
+        self.interval_count = 0
+        self.max_interval = 0.0
+        self.dropped_frames = 0
+
+    def get_intervals(self):
+        """Gets the recorded flip intervals in seconds."""
+        count = min(self.interval_count, FrameTimer.MAX_INTERVALS)
+        return self.intervals[0:count]
+
+    def get_dropped_frames(self):
+        """Gets the number of dropped frames since start_recording()."""
+        return self.dropped_frames
+
+    def get_max_interval(self):
+        """Gets the longest flip interval since start_recording()."""
+        return self.max_interval
+
+    def warm_up(self, stimuli):
+        """Draws each stimulus once into the back buffer, without flipping,
+        so texture uploads and other first-use costs are paid before the
+        trials. Logs the first-draw cost of each stimulus, and returns the
+        costs in seconds."""
+        costs = []
+        for stimulus in stimuli:
+            start = time.time()
+            stimulus.draw()
+            GL.glFinish()
+            costs.append(time.time() - start)
+            log.info('First draw of %s: %.3f ms',
+                     FrameTimer.describe(stimulus), costs[-1] * 1000)
+        self.window.clearBuffer()
+        if costs:
+            log.info('Warm-up of %d stimuli: %.1f ms, slowest %.3f ms',
+                     len(costs), sum(costs) * 1000, max(costs) * 1000)
+        return costs
+
+    def describe(stimulus):
+        """Gets a short description of a stimulus for the log."""
+        if hasattr(stimulus, 'get_position'):
+            return '%s %s %s' % (stimulus.get_name(), stimulus.get_type(),
+                                 stimulus.get_position())
+        return stimulus.__class__.__name__
+    describe = staticmethod(describe)
+
+    def show(self, stimuli, frames, marker = None):
+        """Draws the stimuli on the given number of consecutive frames and
+        returns the onset time. The next flip ends the presentation, so
+        the stimuli are on screen for exactly that number of frames.
+        The marker is sent on the first flip."""
+        onset = None
+        for frame in range(0, frames):
+            for stimulus in stimuli:
+                stimulus.draw()
+            if onset == None:
+                onset = self.flip(marker)
+            else:
+                self.flip()
+        return onset
+
+# An input event: the time it was detected on the experiment clock, the
+# device ("Response Box" or "Keyboard"), the status byte or key name, and
+# whether it was pressed (True) or released (False).
+InputEvent = collections.namedtuple('InputEvent',
+                                    ['time', 'device', 'code', 'pressed'])
+
+class InputService(threading.Thread):
+    """Polls the status port of the parallel port at a fixed rate in a
+    background thread. Every change of the status byte is pushed as a
+    release of the old and a press of the new value into an event queue,
+    so a button that is still held down never produces a new press.
+    The keyboard is either read by an EvdevKeyboard thread, or from the
+    main thread, which moves the keys into the same queue with
+    poll_keyboard()."""
+
+    POLL_RATE = 2000 # Polling rate of the status port in Hz
+    KEYBOARD_INTERVAL = 0.001 # Sleep between two keyboard polls in seconds
+
+    def __init__(self, clock, port):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.clock = clock
+        self.port = port
+        # deque.append and deque.popleft are atomic, the queue is shared
+        # without a lock between the polling and the main thread.
+        self.events = collections.deque()
+        self.arrived = threading.Event()
+        self.status = port.read_status()
+        self.keyboard = None
+        self.running = True
+
+    def run(self):
+        """Polls the status port until stop() is called."""
+        interval = 1.0 / InputService.POLL_RATE
+        while self.running:
+            status = self.port.read_status()
+            if status != self.status:
+                now = self.clock.getTime()
+                self.push(InputEvent(now, "Response Box", self.status, False))
+                self.push(InputEvent(now, "Response Box", status, True))
+                self.status = status
+            time.sleep(interval)
+
+    def push(self, input_event):
+        """Appends an event to the queue."""
+        self.events.append(input_event)
+        self.arrived.set()
+
+    def set_keyboard(self, keyboard):
+        """Takes the keys from an EvdevKeyboard thread instead of the
+        window."""
+        self.keyboard = keyboard
+
+    def stop(self):
+        """Stops the polling thread."""
+        self.running = False
+
+    def clear(self):
+        """Discards all queued events, and all pending keys."""
+        self.events.clear()
+        self.arrived.clear()
+        event.clearEvents(eventType = None)
+
+    def poll_keyboard(self, keys):
+        """Moves pending key presses into the event queue. Has to be
+        called from the main thread. With an EvdevKeyboard, the keys of
+        the window are only discarded."""
+        for key in event.getKeys(keyList = keys):
+            if self.keyboard == None:
+                self.events.append(InputEvent(self.clock.getTime(),
+                                              "Keyboard", key, True))
+
+    def get_event(self):
+        """Returns the oldest queued event, or None."""
+        try:
+            return self.events.popleft()
+        except IndexError:
+            return None
+
+    def get_press(self, codes, keys):
+        """Returns the first queued press of a status byte in codes or of
+        a key in keys, or None. Other events are dropped."""
+        self.poll_keyboard(keys)
+        while True:
+            input_event = self.get_event()
+            if input_event == None:
+                return None
+            if input_event.pressed and (input_event.code in codes or
+                                        input_event.code in keys):
+                return input_event
+
+    def get_release(self, code):
+        """Returns the first queued release of a status byte or key, or
+        None. Other events are dropped."""
+        while True:
+            input_event = self.get_event()
+            if input_event == None:
+                return None
+            if not input_event.pressed and input_event.code == code:
+                return input_event
+
+    def has_release(self, input_event):
+        """Tells if the device of a press also reports its release. Keys
+        read from the window are only pressed."""
+        return (input_event.device == "Response Box" or
+                self.keyboard != None)
+
+    def wait_for_release(self, code, timeout):
+        """Waits for the release of a status byte or key, at most timeout
+        seconds. Returns the event, or None. Other events are dropped."""
+        deadline = self.clock.getTime() + timeout
+        while True:
+            input_event = self.get_release(code)
+            if input_event != None:
+                return input_event
+            remaining = deadline - self.clock.getTime()
+            if remaining <= 0:
+                return None
+            self.wait(remaining)
+
+    def wait(self, timeout):
+        """Blocks until an event arrives from the polling thread or the
+        timeout in seconds is over."""
+        self.arrived.wait(timeout)
+        self.arrived.clear()
+
+    def wait_for_press(self, codes, keys):
+        """Discards pending events and waits for the next press of a status
+        byte in codes or of a key in keys. Returns the event."""
+        self.clear()
+        while True:
+            input_event = self.get_press(codes, keys)
+            if input_event != None:
+                return input_event
+            self.wait(InputService.KEYBOARD_INTERVAL)
+
+class EvdevKeyboard(threading.Thread):
+    """Reads a keyboard directly from its Linux event device
+    (/dev/input/eventN) instead of through the event pump of the window.
+    Key presses and releases carry the time stamps of the kernel, mapped
+    into the experiment clock, and are pushed into an InputService. The
+    device is a file name, or an object with a fileno() method such as a
+    FakeEvdevDevice. The layout ("us" or "qwertz") maps the key codes to
+    the labels of the keys."""
+
+    EVENT_FORMAT = 'llHHi' # struct input_event: timeval, type, code, value
+    EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+    EV_KEY = 0x01
+    KEY_RELEASE = 0
+    KEY_PRESS = 1
+    KEY_REPEAT = 2
+
+    # Linux key codes of the keys used by pvrtask. The codes are physical
+    # key positions, named after a US layout: on a QWERTZ keyboard (German
+    # and Swiss), the key labelled y is at the position of the US z (44).
+    KEY_NAMES = {16: 'q', 20: 't', 21: 'y', 49: 'n', 50: 'm', 57: 'space'}
+    KEY_NAMES_QWERTZ = {16: 'q', 20: 't', 44: 'y', 49: 'n', 50: 'm',
+                        57: 'space'}
+    LAYOUTS = {"us": KEY_NAMES, "qwertz": KEY_NAMES_QWERTZ}
+
+    def __init__(self, clock, input_service, device, layout = "us"):
+        threading.Thread.__init__(self)
+        self.key_names = EvdevKeyboard.LAYOUTS[layout]
+        self.setDaemon(True)
+        self.clock = clock
+        self.input_service = input_service
+        if isinstance(device, str):
+            self.fd = os.open(device, os.O_RDONLY)
+        else:
+            self.fd = device.fileno()
+        self.running = True
+
+    def run(self):
+        """Reads key events until stop() is called or the device is
+        closed."""
+        data = ''
+        while self.running:
+            if not select.select([self.fd], [], [], 0.1)[0]:
+                continue
+            chunk = os.read(self.fd, EvdevKeyboard.EVENT_SIZE * 64)
+            if not chunk:
+                break
+            data = data + chunk
+            while len(data) >= EvdevKeyboard.EVENT_SIZE:
+                self.__handle(struct.unpack(EvdevKeyboard.EVENT_FORMAT,
+                                            data[:EvdevKeyboard.EVENT_SIZE]))
+                data = data[EvdevKeyboard.EVENT_SIZE:]
+
+    def __handle(self, input_event):
+        """Pushes a press or release of a known key into the queue."""
+        seconds, microseconds, event_type, code, value = input_event
+        if (event_type != EvdevKeyboard.EV_KEY or
+            value == EvdevKeyboard.KEY_REPEAT or
+            not code in self.key_names):
+            return
+
+        # The kernel stamps events with the system time, which is mapped
+        # to the experiment clock with the current offset of both.
+        offset = self.clock.getTime() - time.time()
+        self.input_service.push(InputEvent(
+            seconds + microseconds * 1e-6 + offset, "Keyboard",
+            self.key_names[code],
+            value == EvdevKeyboard.KEY_PRESS))
+
+    def stop(self):
+        """Stops reading."""
+        self.running = False
+
+class FakeEvdevDevice:
+    """A fake keyboard event device for development and testing without a
+    keyboard. Events written with press() and release() are read from
+    fileno() in the format of /dev/input/eventN. The keys are given by
+    their labels on a keyboard of the layout ("us" or "qwertz")."""
+
+    def __init__(self, layout = "us"):
+        self.read_fd, self.write_fd = os.pipe()
+        self.key_names = EvdevKeyboard.LAYOUTS[layout]
+
+    def fileno(self):
+        """Gets the file descriptor to read the events from."""
+        return self.read_fd
+
+    def __write(self, key, value, stamp):
+        """Writes a key event and a synchronization event."""
+        if stamp == None:
+            stamp = time.time()
+        seconds = int(stamp)
+        microseconds = int((stamp - seconds) * 1e6)
+        for code, name in self.key_names.items():
+            if name == key:
+                break
+        else:
+            raise ValueError('Unknown key: %s' % key)
+        os.write(self.write_fd,
+                 struct.pack(EvdevKeyboard.EVENT_FORMAT, seconds,
+                             microseconds, EvdevKeyboard.EV_KEY, code,
+                             value) +
+                 struct.pack(EvdevKeyboard.EVENT_FORMAT, seconds,
+                             microseconds, 0, 0, 0))
+
+    def press(self, key, stamp = None):
+        """Presses a key, at the system time stamp or now."""
+        self.__write(key, EvdevKeyboard.KEY_PRESS, stamp)
+
+    def release(self, key, stamp = None):
+        """Releases a key, at the system time stamp or now."""
+        self.__write(key, EvdevKeyboard.KEY_RELEASE, stamp)
+
+    def close(self):
+        """Closes the device, which ends the reading thread."""
+        os.close(self.write_fd)
+
+class DeadlineWaiter:
+    """Waits for deadlines on the experiment clock that are not bound to
+    a frame. Sleeps until shortly before the deadline and spins only for
+    the rest, which avoids both oversleeping and long busy loops. The
+    overshoot of each wait is collected per call site."""
+
+    SPIN_DURATION = 0.0005 # The last part of a wait is spent spinning
+
+    # Overshoot statistics of all waiters: site -> [waits, sum, maximum]
+    overshoots = {}
+    lock = threading.Lock()
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def wait_until(self, deadline, site):
+        """Waits until the deadline and returns the time it returned."""
+        remaining = deadline - self.clock.getTime()
+        if remaining > DeadlineWaiter.SPIN_DURATION:
+            time.sleep(remaining - DeadlineWaiter.SPIN_DURATION)
+        now = self.clock.getTime()
+        while now < deadline:
+            now = self.clock.getTime()
+        self.__count(site, now - deadline)
+        return now
+
+    def wait(self, duration, site):
+        """Waits for duration seconds and returns the time it returned."""
+        return self.wait_until(self.clock.getTime() + duration, site)
+
+    def __count(self, site, overshoot):
+        """Adds the overshoot of a wait to the statistics of its site."""
+        DeadlineWaiter.lock.acquire()
+        try:
+            if not site in DeadlineWaiter.overshoots:
+                DeadlineWaiter.overshoots[site] = [0, 0.0, 0.0]
+            stats = DeadlineWaiter.overshoots[site]
+            stats[0] = stats[0] + 1
+            stats[1] = stats[1] + overshoot
+            stats[2] = max(stats[2], overshoot)
+        finally:
+            DeadlineWaiter.lock.release()
+
+    def get_overshoots(self):
+        """Gets the number of waits, mean and maximum overshoot in
+        seconds per call site."""
+        DeadlineWaiter.lock.acquire()
+        try:
+            result = {}
+            for site, stats in DeadlineWaiter.overshoots.items():
+                result[site] = [stats[0], stats[1] / stats[0], stats[2]]
+            return result
+        finally:
+            DeadlineWaiter.lock.release()
+
+    def report(self):
+        """Logs the overshoot statistics."""
+        overshoots = self.get_overshoots()
+        sites = overshoots.keys()
+        sites.sort()
+        for site in sites:
+            waits, mean, maximum = overshoots[site]
+            log.info('Overshoot %s: %d waits, mean %.1f us, max %.1f us',
+                     site, waits, mean * 1e6, maximum * 1e6)
+
+class RealtimeMode:
+    """Opt-in real-time mode for the blocks of a session. Raises the
+    scheduling priority (SCHED_FIFO, or a high nice value) of the
+    presentation thread and binds it to one CPU; on Linux these act on
+    the calling thread only. The other threads of the process (input,
+    pulse, log and trial preparation) keep their normal priority and are
+    bound to the remaining CPUs, so they neither compete with the
+    presentation thread nor are starved by it. Threads started while the
+    mode is active inherit the CPU of the thread that starts them. Locks
+    all memory of the process, including future allocations of every
+    thread (mlockall is process-wide), and disables the garbage
+    collector, which collects in the pauses instead. Steps that lack the
+    privileges are skipped with a message. Leaving the mode restores the
+    CPUs and logs the preemptions and page faults of the process that
+    occurred in it."""
+
+    PRIORITY = 50 # SCHED_FIFO priority
+    NICE = -20 # Nice value if SCHED_FIFO is not permitted
+    SCHED_OTHER = 0
+    SCHED_FIFO = 1
+    MCL_CURRENT = 1
+    MCL_FUTURE = 2
+    CPU_SET_WORDS = 16 # cpu_set_t of 1024 bits
+
+    def __init__(self, enabled, cpu = None):
+        self.enabled = enabled
+        self.cpu = cpu
+        self.is_active = False
+        self.libc = None
+        if enabled:
+            try:
+                self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                        use_errno = True)
+            except OSError:
+                log.warning('Real-time mode: C library not found.')
+
+    def enter(self):
+        """Enters the real-time mode, for the calling thread."""
+        if not self.enabled or self.is_active:
+            return
+        self.is_active = True
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.nice = os.nice(0)
+        self.affinity = None
+        self.thread_affinities = {} # thread id -> old CPU mask
+        self.is_fifo = False
+        self.is_locked = False
+
+        if self.libc != None:
+            self.__set_scheduler(RealtimeMode.SCHED_FIFO,
+                                 RealtimeMode.PRIORITY)
+            self.__set_affinity()
+            if self.libc.mlockall(RealtimeMode.MCL_CURRENT |
+                                  RealtimeMode.MCL_FUTURE) == 0:
+                self.is_locked = True
+            else:
+                self.__skip('mlockall', ctypes.get_errno())
+
+        if not self.is_fifo:
+            try:
+                os.nice(RealtimeMode.NICE - self.nice)
+            except OSError, error:
+                self.__skip('nice', error.errno)
+
+        gc.disable()
+        log.info('Real-time mode: %s, nice %d, CPU affinity %s, '
+                 '%d other threads moved, memory %s.',
+                 self.is_fifo and 'SCHED_FIFO' or 'SCHED_OTHER', os.nice(0),
+                 self.affinity != None and 'set' or 'unchanged',
+                 len(self.thread_affinities),
+                 self.is_locked and 'locked' or 'not locked')
+
+    def __set_scheduler(self, policy, priority):
+        """Sets the scheduling policy of the calling thread."""
+        param = ctypes.c_int(priority)
+        if self.libc.sched_setscheduler(0, policy, ctypes.byref(param)) == 0:
+            self.is_fifo = (policy == RealtimeMode.SCHED_FIFO)
+        else:
+            self.__skip('sched_setscheduler', ctypes.get_errno())
+
+    def __set_affinity(self):
+        """Binds the calling thread to one CPU, the last one by
+        default."""
+        mask_type = ctypes.c_ulong * RealtimeMode.CPU_SET_WORDS
+        old_mask = mask_type()
+        if self.libc.sched_getaffinity(0, ctypes.sizeof(old_mask),
+                                       old_mask) != 0:
+            self.__skip('sched_getaffinity', ctypes.get_errno())
+            return
+
+        cpu = self.cpu
+        if cpu == None:
+            cpu = os.sysconf('SC_NPROCESSORS_ONLN') - 1
+        bits = ctypes.sizeof(ctypes.c_ulong) * 8
+        mask = mask_type()
+        mask[cpu / bits] = 1 << (cpu % bits)
+        if self.libc.sched_setaffinity(0, ctypes.sizeof(mask), mask) == 0:
+            self.affinity = old_mask
+        else:
+            self.__skip('sched_setaffinity', ctypes.get_errno())
+            return
+
+        # The other threads keep the remaining CPUs of the old mask
+        others = mask_type()
+        for i in range(0, RealtimeMode.CPU_SET_WORDS):
+            others[i] = old_mask[i] & ~mask[i]
+        if [word for word in others if word]:
+            self.__set_thread_affinity(others)
+
+    def __set_thread_affinity(self, mask):
+        """Binds the other threads of the process to the CPUs of the
+        mask, and keeps their old masks."""
+        mask_type = ctypes.c_ulong * RealtimeMode.CPU_SET_WORDS
+        try:
+            own = os.readlink('/proc/thread-self').split('/')[-1]
+            threads = os.listdir('/proc/self/task')
+        except OSError, error:
+            self.__skip('thread affinity', error.errno)
+            return
+        for thread in threads:
+            if thread == own:
+                continue
+            old_mask = mask_type()
+            if (self.libc.sched_getaffinity(int(thread),
+                                            ctypes.sizeof(old_mask),
+                                            old_mask) == 0 and
+                self.libc.sched_setaffinity(int(thread), ctypes.sizeof(mask),
+                                            mask) == 0):
+                self.thread_affinities[int(thread)] = old_mask
+
+    def __skip(self, step, error):
+        """Logs a message about a step that was not permitted."""
+        log.warning('Real-time mode: %s failed (%s), skipped.',
+                    step, os.strerror(error))
+
+    def collect(self):
+        """Runs the garbage collector, e.g. in a pause."""
+        if self.is_active:
+            gc.collect()
+
+    def leave(self):
+        """Leaves the real-time mode and reports what it could not
+        prevent."""
+        if not self.is_active:
+            return
+        self.is_active = False
+        gc.enable()
+
+        if self.is_locked:
+            self.libc.munlockall()
+        if self.affinity != None:
+            self.libc.sched_setaffinity(0, ctypes.sizeof(self.affinity),
+                                        self.affinity)
+        # Threads that have ended in the meantime are ignored
+        for thread, mask in self.thread_affinities.items():
+            self.libc.sched_setaffinity(thread, ctypes.sizeof(mask), mask)
+        if self.is_fifo:
+            self.__set_scheduler(RealtimeMode.SCHED_OTHER, 0)
+        os.nice(self.nice - os.nice(0))
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        preemptions = usage.ru_nivcsw - self.usage.ru_nivcsw
+        page_faults = usage.ru_majflt - self.usage.ru_majflt
+        if preemptions > 0 or page_faults > 0:
+            log.warning('Real-time mode: %d preemptions, '
+                        '%d major page faults.', preemptions, page_faults)
+
+class Pulse:
+    """A TTL pulse on one or more data lines of the parallel port. Stores
+    the times the lines were actually raised and lowered."""
+
+    def __init__(self, lines, duration):
+        self.lines = lines
+        self.duration = duration
+        self.deadline = None
+        self.on_time = None
+        self.off_time = None
+        self.done = threading.Event()
+
+    def wait(self):
+        """Blocks until the pulse is over."""
+        self.done.wait()
+
+    def get_times(self):
+        """Gets the on and off times of the pulse (None while the
+        line is still up)."""
+        return [self.on_time, self.off_time]
+
+class PulseScheduler(threading.Thread):
+    """Sends TTL pulses without blocking the caller. A pulse raises its
+    lines immediately, a timer thread lowers them at the deadline.
+    Overlapping pulses on different lines are combined in the data byte."""
+
+    def __init__(self, clock, port):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.clock = clock
+        self.port = port
+        self.waiter = DeadlineWaiter(clock)
+        self.pending = [] # heap of (deadline, pulse)
+        self.condition = threading.Condition()
+        self.running = True
+
+    def __write(self):
+        """Writes the lines of all pending pulses to the data port."""
+        state = 0x0
+        for deadline, pulse in self.pending:
+            state = state | pulse.lines
+        self.port.write_data(state)
+
+    def pulse(self, lines, duration):
+        """Raises lines for duration seconds and returns the Pulse."""
+        return self.send(Pulse(lines, duration))
+
+    def send(self, pulse):
+        """Raises the lines of a Pulse now and returns it."""
+        self.condition.acquire()
+        try:
+            pulse.on_time = self.clock.getTime()
+            pulse.deadline = pulse.on_time + pulse.duration
+            heapq.heappush(self.pending, (pulse.deadline, pulse))
+            self.__write()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return pulse
+
+    def run(self):
+        """Lowers the lines of each pulse at its deadline."""
+        self.condition.acquire()
+        try:
+            while self.running:
+                if len(self.pending) == 0:
+                    self.condition.wait()
+                    continue
+
+                # Sleep until shortly before the deadline, a new pulse
+                # wakes the thread up. The rest of the wait is done
+                # without holding the lock.
+                deadline = self.pending[0][0]
+                remaining = deadline - self.clock.getTime()
+                if remaining > DeadlineWaiter.SPIN_DURATION:
+                    self.condition.wait(remaining -
+                                        DeadlineWaiter.SPIN_DURATION)
+                    continue
+                if remaining > 0:
+                    self.condition.release()
+                    try:
+                        self.waiter.wait_until(
+                            deadline, "TTL %g s" % self.pending[0][1].duration)
+                    finally:
+                        self.condition.acquire()
+                    continue
+
+                deadline, pulse = heapq.heappop(self.pending)
+                self.__write()
+                pulse.off_time = self.clock.getTime()
+                pulse.done.set()
+        finally:
+            self.condition.release()
+
+    def stop(self):
+        """Stops the timer thread."""
+        self.condition.acquire()
+        self.running = False
+        self.condition.notify()
+        self.condition.release()
+
+class PreparedTrial:
+    """The stimuli of a trial, prepared before the trial starts. The CPU
+    work is done when the object is created, e.g. in the worker thread of
+    the TrialPipeline. Building the stimuli may need the GL context and
+    is done by build (a callable returning fixation cross, central and
+    peripheral stimulus), in the presentation thread."""
+
+    def __init__(self, trial_number, build):
+        self.trial_nr = trial_number
+        self.build = build
+        self.stimuli = None
+        self.prepare_time = 0.0
+        self.build_time = 0.0
+
+    def finish(self):
+        """Builds the stimuli, unless this has been done already."""
+        if self.stimuli == None:
+            start = time.time()
+            self.stimuli = self.build()
+            self.build_time = time.time() - start
+
+    def get_stimuli(self):
+        """Gets fixation cross, central and peripheral stimulus."""
+        self.finish()
+        return self.stimuli
+
+class TrialPipeline(threading.Thread):
+    """Double-buffered preparation of the trials of a session. While a
+    trial runs, a worker thread prepares the next one with prepare (a
+    callable taking the trial index and returning a PreparedTrial), and
+    the GL part is deferred to the flips of the running trial. Starting
+    a trial then only takes the prepared object from the pipeline."""
+
+    def __init__(self, frame_timer, prepare, count):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.frame_timer = frame_timer
+        self.prepare = prepare
+        self.count = count
+        self.prepared = Queue.Queue(1) # The next trial
+        self.is_running = True
+
+    def run(self):
+        """Prepares the trials one after the other. Waits while the next
+        trial has not been taken."""
+        for i in range(0, self.count):
+            if not self.is_running:
+                break
+            start = time.time()
+            trial = self.prepare(i)
+            trial.prepare_time = time.time() - start
+            self.prepared.put(trial)
+            # After stop() the trial is never run, its build is not
+            # deferred to the flips of a later session
+            if not self.is_running:
+                break
+            self.frame_timer.defer(trial.finish)
+
+    def get(self):
+        """Gets the next prepared trial, and logs its preparation time."""
+        trial = self.prepared.get()
+        trial.finish()
+        log.info('Trial %d prepared in %.3f ms, built in %.3f ms',
+                 trial.trial_nr, trial.prepare_time * 1000,
+                 trial.build_time * 1000)
+        return trial
+
+    def stop(self):
+        """Stops preparing trials, and drops the builds that are still
+        deferred. The frame timer is shared with the next session."""
+        self.is_running = False
+        try:
+            self.prepared.get_nowait()
+        except Queue.Empty:
+            pass
+        self.join()
+        self.frame_timer.clear_deferred()
+
+# A phase of the trial timeline: its name, the names of the stimuli drawn
+# on each of its frames ("fix_cross", "central" or "peripheral"), the
+# possible durations in seconds (one is drawn per trial, None: until it
+# is ended), the conditions that end it early ("response", or a function
+# without arguments, e.g. asking the eye tracker for the gaze), and the
+# data lines of the marker sent on its first flip (None: no marker).
+Phase = collections.namedtuple('Phase', ['name', 'stimuli', 'durations',
+                                         'until', 'marker'])
+
+class Timeline:
+    """The phases of a trial, compiled once per session: durations are
+    converted into frames and the end conditions are sorted out, so
+    running a trial only counts flips. Responses are collected from the
+    onset of the response phase on. A phase that ends on a response ends
+    after its first flip if the response came before, so the following
+    phase clears the stimulus and the trial ends."""
+
+    def __init__(self, phases, frame_timer, input_service, response_phase,
+                 marker_duration, seed = None):
+        self.frame_timer = frame_timer
+        self.input_service = input_service
+        self.response_phase = response_phase
+        self.marker_duration = marker_duration
+        self.generator = random.Random(seed)
+
+        self.phases = []
+        for phase in phases:
+            frames = []
+            for duration in phase.durations:
+                if duration == None:
+                    frames.append(None)
+                else:
+                    frames.append(frame_timer.get_frames(
+                        duration, "%s duration" % phase.name))
+            on_response = False
+            conditions = []
+            for condition in phase.until:
+                if condition == "response":
+                    on_response = True
+                elif callable(condition):
+                    conditions.append(condition)
+                else:
+                    raise ValueError('Unknown end of phase %s: %s' %
+                                     (phase.name, condition))
+            assert not None in frames or phase.until, \
+                   "Phase %s never ends!" % phase.name
+            self.phases.append((phase.name, phase.stimuli, frames,
+                                on_response, conditions, phase.marker))
+        assert response_phase in [phase.name for phase in phases]
+
+    def run(self, stimuli, codes, keys, durations = {}):
+        """Runs the phases of a trial. The stimuli are given by name, the
+        codes and keys are the accepted responses, and durations replace
+        the durations of phases (by name, in seconds) in this trial.
+        Returns the onset and the end (the flip that cleared it) of each
+        phase by name, the markers, and the first response (None
+        without)."""
+        onsets = {}
+        ends = {}
+        markers = []
+        response = None
+        collecting = False
+        last = None
+        for name, names, frames, on_response, conditions, lines in \
+            self.phases:
+            drawn = [stimuli[stimulus] for stimulus in names]
+            count = frames[0]
+            if name in durations:
+                count = self.frame_timer.get_frames(durations[name],
+                                                    "%s duration" % name)
+            elif len(frames) > 1:
+                count = self.generator.choice(frames)
+            marker = None
+            if lines != None:
+                marker = Pulse(lines, self.marker_duration)
+            markers.append(marker)
+            if name == self.response_phase:
+                # Earlier presses and buttons that are still held down
+                # are not taken as response
+                self.input_service.clear()
+                collecting = True
+
+            frame = 0
+            while count == None or frame < count:
+                if frame == 0 or drawn or count != None:
+                    for stimulus in drawn:
+                        stimulus.draw()
+                    if frame == 0:
+                        onsets[name] = self.frame_timer.flip(marker)
+                        if last != None:
+                            ends[last] = onsets[name]
+                    else:
+                        self.frame_timer.flip()
+                else:
+                    # Without flips, sleep until the next event or
+                    # keyboard poll
+                    self.input_service.wait(InputService.KEYBOARD_INTERVAL)
+                frame = frame + 1
+
+                if collecting and response == None:
+                    response = self.input_service.get_press(codes, keys)
+                if response != None and on_response:
+                    break
+                if conditions and [c for c in conditions if c()]:
+                    break
+            last = name
+            if not drawn:
+                last = None
+
+        # Clear the stimuli of the last phase
+        if last != None:
+            ends[last] = self.frame_timer.flip()
+        return onsets, ends, markers, response
+
 class Trial:
     """A Trial shows a central and peripheral stimulus.
     In each Trial, user input and the notification of
@@ -54,17 +1225,71 @@ class Trial:
     port."""
     FIX_CROSS_DUR = 1.0 # 2.0
     STIM_DUR = 1.0 # 2.0
-    TTL_ON = 0x2
-    TTL_OFF = 0x0
+    TTL_ON = 0x2 # Data line of the trial marker
     TTL_DURATION = 0.050 # 50 ms is fine for 50Hz and 200Hz Tracking
+    RELEASE_TIMEOUT = 0.5 # Longest wait for the release of the response
+
+    # Data lines of the markers sent on the flip that shows the fixation
+    # cross, the central and the peripheral stimulus (None: no marker).
+    # The eye tracker expects one marker per trial.
+    MARKER_FIX_CROSS = TTL_ON
+    MARKER_CENTER_STIM = None
+    MARKER_PERI_STIM = None
+
+    # Onset asynchronies of the central and the peripheral stimulus in
+    # seconds, one is drawn per trial, e.g. [0.5, 0.75, 1.0]
+    SOA = [STIM_DUR]
+
+    # The timeline of a trial. The peripheral stimulus stays on for
+    # STIM_DUR, then the trial waits for the response on a blank screen.
+    # Response times are taken from the onset of the RESPONSE_PHASE.
+    PHASES = [Phase("fix_cross", ["fix_cross"], [FIX_CROSS_DUR], [],
+                    MARKER_FIX_CROSS),
+              Phase("central", ["central"], SOA, [], MARKER_CENTER_STIM),
+              Phase("peripheral", ["peripheral"], [STIM_DUR], [],
+                    MARKER_PERI_STIM),
+              Phase("response", [], [None], ["response"], None)]
+    # The same timeline, but the peripheral stimulus ends early when the
+    # subject responds (--end-on-response)
+    PHASES_END_ON_RESPONSE = PHASES[:2] + \
+        [Phase("peripheral", ["peripheral"], [STIM_DUR], ["response"],
+               MARKER_PERI_STIM)] + PHASES[3:]
+    RESPONSE_PHASE = "peripheral"
+
     KBOARD_ANSWER_YES = 'y'
     KBOARD_ANSWER_NO = 'n'
     KBOARD_ANSWER_QUIT = 'q'
     BBOX_ANSWER_LEFT = 0x38
     BBOX_ANSWER_RIGHT = 0x68
 
+    # Legend of the timer in the data file. This has to match the
+    # element order of the timer.
+    VAR_NAMES = ['trial_nr',
+                 'block_nr',
+                 'trial_start',
+                 'central_stim_name',
+                 'central_stim_type',
+                 'central_stim_position',
+                 'peri_stim_name',
+                 'peri_stim_type',
+                 'peri_stim_position',
+                 'fixation_point_on',
+                 'center_stim_on',
+                 'peri_stim_on',
+                 'peri_stim_off',
+                 'response',
+                 'response_time',
+                 'ttl_on',
+                 'ttl_off',
+                 'dropped_frames',
+                 'max_frame_interval',
+                 'response_down',
+                 'response_up']
+
     def __init__(self, input_device, handedness, clock, trial_number,
-                 block_number, fix_cross, central_stim, peri_stim, window):
+                 block_number, fix_cross, central_stim, peri_stim, window,
+                 frame_timer, input_service, pulse_scheduler, timeline,
+                 durations = {}):
 
         Trial.input_type = input_device
         Trial.handedness = handedness
@@ -76,72 +1301,63 @@ class Trial:
         self.central_stim = central_stim
         self.peri_stim = peri_stim
         Trial.window = window
+        Trial.frame_timer = frame_timer
+        Trial.input_service = input_service
+        Trial.pulse_scheduler = pulse_scheduler
+        Trial.timeline = timeline
+        self.durations = durations # Durations of phases in this trial
 
         self.timer = None
         self.__run()
 
     def __run(self):
-        """ Runs the trial until subject responds."""
+        """ Runs the phases of the trial until subject responds."""
         # Start of the trial
         trial_start = Trial.clock.getTime()
-        portio.outb(Trial.TTL_ON, 0x378)
-        time.sleep(Trial.TTL_DURATION)
-        portio.outb(Trial.TTL_OFF, 0x378)
-
-        # Fixation Cross
-        self.fix_cross.draw()
-        Trial.window.flip(clearBuffer = True)
-        fix_cross_on = self.clock.getTime()
-        time.sleep(Trial.FIX_CROSS_DUR)
-
-        # Center Stimulus
-        self.central_stim.draw()
-        Trial.window.flip(clearBuffer = True)
-        center_stim_on = self.clock.getTime()
-        time.sleep(Trial.STIM_DUR)
-
-        # Peripheral Stimulus and Response
-        self.peri_stim.draw()
-        Trial.window.flip(clearBuffer = True)
-        peri_stim_on = self.clock.getTime()
-        is_stim_on = True
-
-        # Get user response
-        while True:
-            response_box = portio.inb(0x379)
-            response_keyb = event.getKeys(keyList =
-                                          [Trial.KBOARD_ANSWER_YES,
-                                           Trial.KBOARD_ANSWER_NO,
-                                           Trial.KBOARD_ANSWER_QUIT])
-
-            # Flip stimulus when stimulus duration is reached
-            # before subject response.
-            if (is_stim_on and
-                self.clock.getTime() - peri_stim_on >= Trial.STIM_DUR):
-                Trial.window.flip(clearBuffer = True)
-                peri_stim_off = self.clock.getTime()
-                is_stim_on = False
-
-            # Get response time
-            if (response_box == Trial.BBOX_ANSWER_RIGHT or
-                response_box == Trial.BBOX_ANSWER_LEFT or
-                len(response_keyb) > 0):
-                reaction_time = self.clock.getTime() - peri_stim_on
-                break
-
-        # Flip stimulus when stimulus duration is reached
-        # after subject response
-        if is_stim_on:
-            while True:
-                if (self.clock.getTime() - peri_stim_on >= Trial.STIM_DUR):
-                    Trial.window.flip(clearBuffer = True)
-                    peri_stim_off = self.clock.getTime()
-                    break
-
-        if  Trial.input_type == "Keyboard":
-            response = response_keyb[0] # We only take the first key pressed
+        Trial.frame_timer.start_recording()
+
+        # Answers of the selected input device. The quit key is
+        # always accepted.
+        if Trial.input_type == "Keyboard":
+            codes = []
+            keys = [Trial.KBOARD_ANSWER_YES,
+                    Trial.KBOARD_ANSWER_NO,
+                    Trial.KBOARD_ANSWER_QUIT]
         elif Trial.input_type == "Response Box":
-            response = response_box
+            codes = [Trial.BBOX_ANSWER_LEFT, Trial.BBOX_ANSWER_RIGHT]
+            keys = [Trial.KBOARD_ANSWER_QUIT]
+
+        stimuli = {"fix_cross": self.fix_cross,
+                   "central": self.central_stim,
+                   "peripheral": self.peri_stim}
+        onsets, ends, self.markers, response_event = \
+            Trial.timeline.run(stimuli, codes, keys, self.durations)
+        fix_cross_on = onsets["fix_cross"]
+        center_stim_on = onsets["central"]
+        peri_stim_on = onsets["peripheral"]
+        peri_stim_off = ends["peripheral"]
+
+        # A timeline that does not wait for the response can end
+        # without one, the trial is then kept without response
+        response = None
+        reaction_time = None
+        response_down = None
+        response_up = None
+        if response_event != None:
+            reaction_time = (response_event.time -
+                             onsets[Trial.RESPONSE_PHASE])
+
+            # We only take the first key or button pressed. The trial ends
+            # right after the press, so its release is awaited on the
+            # blank screen before the next trial, if the device reports it.
+            response = response_event.code
+            response_down = response_event.time
+            if (response != Trial.KBOARD_ANSWER_QUIT and
+                Trial.input_service.has_release(response_event)):
+                response_release = Trial.input_service.wait_for_release(
+                    response, Trial.RELEASE_TIMEOUT)
+                if response_release != None:
+                    response_up = response_release.time
 
         # Assign response box response
         if response == Trial.BBOX_ANSWER_RIGHT:
@@ -161,16 +1377,17 @@ class Trial:
         assert (self.peri_stim.get_position() == "left" or
                 self.peri_stim.get_position() == "right")
 
-        # We only use timer data when yes or no was responded.
+        # We only use timer data when yes or no or nothing was responded.
         # We don't want timer data if quit was pressed
-        if (response == 'button_left' or
+        if (response == None or
+            response == 'button_left' or
             response == 'button_right'or
             response == Trial.KBOARD_ANSWER_YES  or
             response == Trial.KBOARD_ANSWER_NO):
 
             # the element order of the timer has to match the
             # legend of the output file, so be careful with changes,
-            # and don't forget to change the data file legend also.
+            # and don't forget to change Trial.VAR_NAMES also.
             self.timer = [self.trial_nr,
                           self.block_nr,
                           trial_start,
@@ -185,8 +1402,19 @@ class Trial:
                           peri_stim_on,
                           peri_stim_off,
                           response,
-                          reaction_time]
-            print self.timer
+                          reaction_time] + self.__get_ttl_times() + \
+                         [Trial.frame_timer.get_dropped_frames(),
+                          Trial.frame_timer.get_max_interval(),
+                          response_down,
+                          response_up]
+            log.info('%s', self.timer)
+
+    def __get_ttl_times(self):
+        """Gets the on and off time of the first marker of the trial."""
+        for marker in self.markers:
+            if marker != None:
+                return marker.get_times()
+        return [None, None]
 
     def get_timer(self):
         """Returns the timer data of the trial"""
@@ -225,30 +1453,130 @@ class SquareStim(visual.ShapeStim):
         """Gets the position (left central, or right) of the stimulus."""
         return self.position.get_name()
 
-class LandoltStim(visual.TextStim):
+class LandoltStim:
     """A Landolt stimulus: has an orientation (opened to the top or bottom) and
     a position (left, central or right), and can be drawn on a window."""
 
-    FONT = 'Sloan'
-
-    # The sloan font was downloaded from
-    # http://www.psych.nyu.edu/pelli/software.html
-    # and published here:
-    # Pelli, D. G., Robson, J. G., & Wilkins, A. J. (1988) The design of a
-    # new letter chart for measuring contrast sensitivity.  Clinical Vision
-    # Sciences 2, 187-199.
-
-    def __init__(self, orientation, position, window):
+    # The ring is drawn from its geometry instead of the letter C of the
+    # Sloan font, with the proportions of the standard Landolt C (ISO 8596):
+    # the outer diameter D is the stimulus height, stroke and gap are D/5.
+    # The gap has parallel sides. A ring of diameter 1, opened to the right,
+    # is built once as a triangle strip and kept in a vertex buffer per
+    # window; size, orientation and position are applied when drawing. As
+    # for the TextStim before, the orientation turns the ring clockwise.
+    #
+    # The size matches the letter C of others/Sloan.otf, which the TextStim
+    # drew with the stimulus height as its em size: in the 1000 units of
+    # the em (ascent 1000, descent 0), the outline of the C is a ring of
+    # outer radius 500 and inner radius 300 around (500, 500), opened to
+    # the right between y = 400 and 600 with horizontal edges up to
+    # x = 990. So its outer diameter is the em, stroke and gap are 1/5 of
+    # it, and the glyph is centered on the line like the ring.
+
+    SLOAN_SCALE = 1.0 # Outer diameter of the Sloan C relative to its em
+    STROKE = 0.2 # Stroke width relative to the outer diameter
+    GAP = 0.2 # Gap width relative to the outer diameter
+    SEGMENTS = 128 # Number of segments of the ring
+    COLOR = [1, 1, 1]
+
+    vertices = None # Vertices of the unit ring, shared by all Landolts
+    buffers = {} # window -> vertex buffer object
+
+    def __init__(self, orientation, position, window, height = None):
         self.myname = "landolt"
         self.orientation = orientation
         self.position = position
-        visual.TextStim.__init__(self,
-                                 window,
-                                 text="C",
-                                 ori=orientation.get_orientation(),
-                                 height=position.get_landolt_size(),
-                                 pos=position.get_landolt_position(),
-                                 font=LandoltStim.FONT)
+        self.win = window
+        # The height (the em of the Sloan font before) in degrees, given
+        # by the position by default
+        self.height = height
+        if height == None:
+            self.height = self.get_height()
+
+        # Outer diameter and position in pixels
+        self.size = misc.deg2pix(self.height * LandoltStim.SLOAN_SCALE,
+                                 window.monitor)
+        self.pos = [misc.deg2pix(x, window.monitor)
+                    for x in position.get_landolt_position()]
+        self.ori = orientation.get_orientation()
+
+        if LandoltStim.vertices == None:
+            LandoltStim.vertices = LandoltStim.create_vertices()
+
+    def get_height(self):
+        """Gets the height in degrees."""
+        return self.position.get_landolt_size()
+
+    def create_vertices():
+        """Creates the vertices of the ring with diameter 1 around the
+        origin, opened to the right, as a triangle strip of pairs of an
+        outer and an inner vertex."""
+        outer = 0.5
+        inner = 0.5 - LandoltStim.STROKE
+        half_gap = LandoltStim.GAP / 2
+
+        # The ends of the ring lie at the height of the gap edges
+        outer_start = math.asin(half_gap / outer)
+        inner_start = math.asin(half_gap / inner)
+        strip = []
+        for i in range(0, LandoltStim.SEGMENTS + 1):
+            t = float(i) / LandoltStim.SEGMENTS
+            a = outer_start + t * (2 * math.pi - 2 * outer_start)
+            b = inner_start + t * (2 * math.pi - 2 * inner_start)
+            strip.extend([outer * math.cos(a), outer * math.sin(a),
+                          inner * math.cos(b), inner * math.sin(b)])
+        return (GL.GLfloat * len(strip))(*strip)
+    create_vertices = staticmethod(create_vertices)
+
+    def __get_buffer(self, win):
+        """Gets the vertex buffer of the ring in the window, and uploads
+        it on the first draw."""
+        if win not in LandoltStim.buffers:
+            buffer_id = GL.GLuint()
+            GL.glGenBuffers(1, ctypes.byref(buffer_id))
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer_id)
+            GL.glBufferData(GL.GL_ARRAY_BUFFER,
+                            ctypes.sizeof(LandoltStim.vertices),
+                            LandoltStim.vertices, GL.GL_STATIC_DRAW)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+            LandoltStim.buffers[win] = buffer_id
+            resources.add(win, 'vertex buffer', 'landolt',
+                          ctypes.sizeof(LandoltStim.vertices),
+                          lambda: LandoltStim.delete_buffer(win))
+        return LandoltStim.buffers[win]
+
+    def draw(self, win = None):
+        """Draws the ring on the window."""
+        if win == None:
+            win = self.win
+        win.winHandle.switch_to()
+        win.setScale('pix')
+        GL.glPushMatrix()
+        GL.glTranslatef(self.pos[0], self.pos[1], 0)
+        GL.glRotatef(-self.ori, 0.0, 0.0, 1.0)
+        GL.glScalef(self.size, self.size, 1.0)
+        GL.glColor4f((LandoltStim.COLOR[0] + 1) / 2.0,
+                     (LandoltStim.COLOR[1] + 1) / 2.0,
+                     (LandoltStim.COLOR[2] + 1) / 2.0, 1.0)
+
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.__get_buffer(win))
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glVertexPointer(2, GL.GL_FLOAT, 0, None)
+        GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 0,
+                        len(LandoltStim.vertices) // 2)
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        GL.glPopMatrix()
+
+    def delete_buffer(win):
+        """Deletes the vertex buffer of the ring in the window. It is
+        shared by all Landolts of the window, so it is only deleted when
+        the window is closed, by the resource manager."""
+        if win in LandoltStim.buffers:
+            buffer_id = LandoltStim.buffers.pop(win)
+            GL.glDeleteBuffers(1, ctypes.byref(buffer_id))
+            resources.remove(win, 'vertex buffer', 'landolt')
+    delete_buffer = staticmethod(delete_buffer)
 
     def get_name(self):
         """Gets the name of the stimulus."""
@@ -262,69 +1590,131 @@ class LandoltStim(visual.TextStim):
         """Gets the position (left central, or right) of the stimulus."""
         return self.position.get_name()
 
-class LandoltStimSmall(visual.TextStim):
+class LandoltStimSmall(LandoltStim):
     """A small Landolt stimulus: has an orientation (opened to the top or bottom) and
     a position (left, central or right), and can be drawn on a window."""
 
-    FONT = 'Sloan'
-
-    # The sloan font was downloaded from
-    # http://www.psych.nyu.edu/pelli/software.html
-    # and published here:
-    # Pelli, D. G., Robson, J. G., & Wilkins, A. J. (1988) The design of a
-    # new letter chart for measuring contrast sensitivity.  Clinical Vision
-    # Sciences 2, 187-199.
-
-    def __init__(self, orientation, position, window):
+    def __init__(self, orientation, position, window, height = None):
+        LandoltStim.__init__(self, orientation, position, window, height)
         self.myname = "landoltsmall"
-        self.orientation = orientation
-        self.position = position
-        visual.TextStim.__init__(self,
-                                 window,
-                                 text="C",
-                                 ori=orientation.get_orientation(),
-                                 height=position.get_landoltsmall_size(),
-                                 pos=position.get_landolt_position(),
-                                 font=LandoltStim.FONT)
-
-    def get_name(self):
-        """Gets the name of the stimulus."""
-        return self.myname
-
-    def get_type(self):
-        """Gets the orientation of the stimulus."""
-        return self.orientation.get_name()
 
-    def get_position(self):
-        """Gets the position (left central, or right) of the stimulus."""
-        return self.position.get_name()
-
-
-class SwordStim(visual.TextStim):
+    def get_height(self):
+        """Gets the height in degrees."""
+        return self.position.get_landoltsmall_size()
+
+
+class GlyphAtlas:
+    """The glyphs of the sWord characters in one font and size. The glyphs
+    are rendered once into the texture atlas of the font, and strings are
+    composed of their quads, so a new string costs no text rendering."""
+
+    atlases = {} # (font, size in pixels) -> GlyphAtlas
+
+    def __init__(self, font, size):
+        # Same rasterization as a TextStim: size in pixels at 72 dpi
+        self.font = pyglet.font.load(font, size, dpi=72)
+        self.name = font
+        self.size = size
+        self.glyphs = {}
+        self.__add(''.join(Sword.ALPHABET + Sword.SELECTION))
+
+    def get(font, size):
+        """Gets the atlas of the font in the size, and creates it if it
+        does not exist yet. Needs the GL context of a window."""
+        key = (font, size)
+        if key not in GlyphAtlas.atlases:
+            GlyphAtlas.atlases[key] = GlyphAtlas(font, size)
+        return GlyphAtlas.atlases[key]
+    get = staticmethod(get)
+
+    def __add(self, text):
+        """Renders the glyphs of the characters into the atlas. The atlas
+        is shared by all windows, its glyphs (one byte per pixel) are
+        registered as one object."""
+        for char, glyph in zip(text, self.font.get_glyphs(text)):
+            self.glyphs[char] = glyph
+        size = sum([glyph.width * glyph.height
+                    for glyph in self.glyphs.values()])
+        resources.add(None, 'glyph atlas', (self.name, self.size), size)
+
+    def get_glyphs(self, text):
+        """Gets the glyphs of a string. Characters outside the sWord
+        alphabet are added to the atlas on first use."""
+        missing = [char for char in text if char not in self.glyphs]
+        if missing:
+            self.__add(''.join(missing))
+        return [self.glyphs[char] for char in text]
+
+    def get_ascent(self):
+        """Gets the ascent of the font in pixels."""
+        return self.font.ascent
+
+    def get_descent(self):
+        """Gets the descent of the font in pixels (negative)."""
+        return self.font.descent
+
+class SwordStim:
     """A Char stimulus: has a position (left, central or right), a color,
     and can be drawn on a window."""
 
     FONT = 'FreeSans'
 
-    # The sloan font was downloaded from
-    # http://www.psych.nyu.edu/pelli/software.html
-    # and published here:
-    # Pelli, D. G., Robson, J. G., & Wilkins, A. J. (1988) The design of a
-    # new letter chart for measuring contrast sensitivity.  Clinical Vision
-    # Sciences 2, 187-199.
-
-    def __init__(self, color, position, window, char):
-        self.aName = char
-        self.myColor = color # myColor because mother class occupies color property
+    def __init__(self, color, position, window, char, match = None):
+        self.myColor = color # myColor like in the TextStim version
         self.position = position
-        visual.TextStim.__init__(self,
-                                 window,
-                                 text=char,
-                                 height=position.get_sword_size(),
-                                 pos=position.get_landolt_position(),
-                                 font=SwordStim.FONT,
-                                 color=color.get_color())
-        self.selection = ['i', 'o', 'x', 'v']
+        self.win = window
+        self.pos = [misc.deg2pix(x, window.monitor)
+                    for x in position.get_landolt_position()]
+        size = int(misc.deg2pix(position.get_sword_size(), window.monitor))
+        self.atlas = GlyphAtlas.get(SwordStim.FONT, size)
+        self.set_text(char, match)
+
+    def set_text(self, char, match = None):
+        """Sets the string, and lays out its glyph quads centered around
+        the position. match tells if the string contains a selected
+        character, it is looked up if not given (e.g. by a SwordCorpus)."""
+        self.aName = char
+        if match == None:
+            match = [selected for selected in Sword.SELECTION
+                     if selected in char] != []
+        self.match = match
+        glyphs = self.atlas.get_glyphs(char)
+        x = -sum([glyph.advance for glyph in glyphs]) / 2.0
+        y = -(self.atlas.get_ascent() + self.atlas.get_descent()) / 2.0
+        self.quads = []
+        for glyph in glyphs:
+            x1, y1, x2, y2 = glyph.vertices
+            self.quads.append((glyph.texture.id,
+                               [x + x1, y + y1, x + x2, y + y2],
+                               glyph.tex_coords))
+            x = x + glyph.advance
+
+    def draw(self, win = None):
+        """Draws the quads of the string on the window."""
+        if win == None:
+            win = self.win
+        win.winHandle.switch_to()
+        win.setScale('pix')
+        GL.glPushMatrix()
+        GL.glTranslatef(self.pos[0], self.pos[1], 0)
+        color = self.myColor.get_color()
+        GL.glColor4f((color[0] + 1) / 2.0, (color[1] + 1) / 2.0,
+                     (color[2] + 1) / 2.0, 1.0)
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        for texture, (x1, y1, x2, y2), t in self.quads:
+            GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+            GL.glBegin(GL.GL_QUADS)
+            GL.glTexCoord2f(t[0], t[1])
+            GL.glVertex2f(x1, y1)
+            GL.glTexCoord2f(t[3], t[4])
+            GL.glVertex2f(x2, y1)
+            GL.glTexCoord2f(t[6], t[7])
+            GL.glVertex2f(x2, y2)
+            GL.glTexCoord2f(t[9], t[10])
+            GL.glVertex2f(x1, y2)
+            GL.glEnd()
+        GL.glDisable(GL.GL_TEXTURE_2D)
+        GL.glPopMatrix()
 
     def get_name(self):
         """Gets the name of the stimulus."""
@@ -334,14 +1724,10 @@ class SwordStim(visual.TextStim):
         """Gets the type of the stimulus, match or nomatch"""
         if self.myColor.get_name() != 'white' or len(self.aName) == 1:
             return self.myColor.get_name()
+        elif self.match:
+            return 'match'
         else:
-            if (string.find(self.aName, self.selection[0]) >= 0 or
-                string.find(self.aName, self.selection[1]) >= 0 or
-                string.find(self.aName, self.selection[2]) >= 0 or
-                string.find(self.aName, self.selection[3]) >= 0 ):
-                return 'match'
-            else:
-                return 'nomatch'
+            return 'nomatch'
 
     def get_position(self):
         """Gets the position (left central, or right) of the stimulus."""
@@ -391,6 +1777,7 @@ class Position:
 
     def __init__(self, position, eyeheight):
         self.name = position
+        self.eyeheight = float(eyeheight)
 
         # Convert eye height in cm to window coordinate units. This linear
         # function is used to exactly display the stimuli at eye height.
@@ -454,6 +1841,10 @@ class Position:
         """Gets the position name."""
         return self.name
 
+    def get_key(self):
+        """Gets the key of the position in the stimulus cache."""
+        return (self.name, self.eyeheight)
+
     def get_square_position(self):
         """Gets the position vector of the Square."""
         return self.square_position
@@ -518,6 +1909,10 @@ class Color:
         """Gets the color name"""
         return self.name
 
+    def get_key(self):
+        """Gets the key of the color in the stimulus cache."""
+        return self.name
+
     def get_color(self):
         """Gets the RGB vector"""
         return self.color
@@ -541,14 +1936,168 @@ class Orientation:
         """Gets the orientation name"""
         return self.name
 
+    def get_key(self):
+        """Gets the key of the orientation in the stimulus cache."""
+        return self.name
+
     def get_orientation(self):
         """Gets the orientation in degrees"""
         return self.orientation
 
+class StimulusCache:
+    """A bounded cache of the stimulus objects, shared by all sessions and
+    screens. A stimulus is built once per window and reused as long as the
+    window is open; the least recently used stimulus is dropped when the
+    cache is full. A dropped stimulus may still be used by a running
+    session, so its textures are only freed with its window. Hits, misses
+    and the time spent building are counted."""
+
+    SIZE = 512 # Maximum number of stimuli in the cache
+
+    def __init__(self, size = SIZE):
+        self.size = size
+        self.stimuli = collections.OrderedDict()
+        self.windows = {} # key -> window the stimulus was built on
+        self.hits = 0
+        self.misses = 0
+        self.build_time = 0.0
+
+    def __key(self, arg):
+        """Converts a constructor argument into a hashable key. Positions,
+        colors and orientations have their own key, windows and other
+        objects are identified by their id."""
+        if hasattr(arg, 'get_key'):
+            return arg.get_key()
+        elif isinstance(arg, (list, tuple)):
+            return tuple([self.__key(a) for a in arg])
+        elif isinstance(arg, (str, unicode, int, long, float)):
+            return arg
+        return id(arg)
+
+    def get(self, kind, *args):
+        """Gets the stimulus of the given class built with the given
+        arguments, building it on a miss."""
+        key = (kind,) + tuple([self.__key(arg) for arg in args])
+        if key in self.stimuli:
+            self.hits = self.hits + 1
+            stimulus = self.stimuli.pop(key)
+        else:
+            self.misses = self.misses + 1
+            start = time.time()
+            stimulus = kind(*args)
+            self.build_time = self.build_time + time.time() - start
+            self.windows[key] = [arg for arg in args
+                                 if isinstance(arg, visual.Window)]
+            if len(self.stimuli) >= self.size:
+                old_key, old = self.stimuli.popitem(last = False)
+                del self.windows[old_key]
+        self.stimuli[key] = stimulus # most recently used last
+        return stimulus
+
+    def release_window(self, win):
+        """Drops all stimuli built on the window and frees their textures.
+        Must be called before the window is closed, while its GL context
+        is still valid. Objects shared by the stimuli of the window, e.g.
+        vertex buffers, are freed by the resource manager."""
+        for key in self.stimuli.keys():
+            if win in self.windows[key]:
+                del self.windows[key]
+                stimulus = self.stimuli.pop(key)
+                if hasattr(stimulus, 'clearTextures'):
+                    stimulus.clearTextures()
+
+    def get_stats(self):
+        """Gets hits, misses, size and build time in seconds."""
+        return [self.hits, self.misses, len(self.stimuli), self.build_time]
+
+    def report(self):
+        """Logs the cache statistics."""
+        hits, misses, size, build_time = self.get_stats()
+        log.info('Stimulus cache: %d hits, %d misses, %d cached, '
+                 '%.1f ms building', hits, misses, size, build_time * 1000)
+
+# The stimulus cache shared by all sessions and screens
+stimulus_cache = StimulusCache()
+
+class ResourceManager:
+    """Keeps track of the windows and of the GL objects created for them
+    (e.g. vertex buffers and glyph textures), with their size in bytes.
+    Closing a window through the manager releases its cached stimuli and
+    all its objects first, while the GL context is still valid. Objects
+    that are shared by all windows are registered without a window."""
+
+    def __init__(self):
+        self.windows = []
+        self.objects = {} # (window, kind, key) -> [bytes, release]
+
+    def open_window(self, **args):
+        """Opens a psychopy window with the given arguments."""
+        win = visual.Window(**args)
+        self.windows.append(win)
+        return win
+
+    def add(self, win, kind, key, size, release = None):
+        """Registers an object of a window. release (a callable) frees it
+        when the window is closed."""
+        self.objects[(win, kind, key)] = [size, release]
+
+    def remove(self, win, kind, key):
+        """Unregisters an object that has been freed."""
+        self.objects.pop((win, kind, key), None)
+
+    def close_window(self, win):
+        """Releases the stimuli and objects of the window, and closes it."""
+        stimulus_cache.release_window(win)
+        for key in self.objects.keys():
+            if key[0] is win:
+                size, release = self.objects.pop(key)
+                if release != None:
+                    release()
+        win.close()
+        if win in self.windows:
+            self.windows.remove(win)
+
+    def get_counts(self):
+        """Gets the number of live objects and their bytes per kind."""
+        counts = {'window': [len(self.windows), 0],
+                  'cached stimulus': [len(stimulus_cache.stimuli), 0]}
+        for (win, kind, key), (size, release) in self.objects.items():
+            count = counts.setdefault(kind, [0, 0])
+            count[0] = count[0] + 1
+            count[1] = count[1] + size
+        return counts
+
+    def report(self):
+        """Logs the live objects."""
+        counts = self.get_counts()
+        kinds = counts.keys()
+        kinds.sort()
+        log.info('Live resources: %s', ', '.join(
+            ['%d %s (%d bytes)' % (counts[kind][0], kind, counts[kind][1])
+             for kind in kinds]))
+
+# The windows and GL objects of the whole program
+resources = ResourceManager()
+
 class Stimuli:
     """Creates a container for the fixation cross,
     and the central an peripheral stimuli."""
 
+    # Factors of the design. The stimulus type selects squares (red and
+    # yellow) or Landolts (down and up), the central and peripheral
+    # levels select one of the two, and the side is the peripheral
+    # position.
+    FACTORS = [("stimulus", ["square", "landolt"]),
+               ("central", [0, 1]),
+               ("peripheral", [0, 1]),
+               ("side", ["left", "right"])]
+    MAX_RUNS = {} # Maximum run length of a factor's level, e.g. side: 3
+
+    INSTRUCTIONS = """
+        Wenn die beiden Figuren gleich sind, druecken Sie mit dem linken Daumen.
+
+        """
+
     def __init__(self, win, eyeheight):
 
         # Square colors
@@ -565,30 +2114,51 @@ class Stimuli:
         right = Position("right", eyeheight)
 
         # Fixation Cross
-        self.fix_cross = Point(win, central.get_fixcross_position())
+        self.fix_cross = stimulus_cache.get(Point, win, central.get_fixcross_position())
 
         # Central Stimuli (No. 0, 1, 2, 3)
-        sq_red_c = SquareStim(red, central, win)
-        sq_yel_c = SquareStim(yellow, central, win)
-        lt_dn_c = LandoltStim(down, central, win)
-        lt_up_c = LandoltStim(up, central, win)
+        sq_red_c = stimulus_cache.get(SquareStim, red, central, win)
+        sq_yel_c = stimulus_cache.get(SquareStim, yellow, central, win)
+        lt_dn_c = stimulus_cache.get(LandoltStim, down, central, win)
+        lt_up_c = stimulus_cache.get(LandoltStim, up, central, win)
 
         # Peripheral Squares (No. 0, 1, 2, 3)
-        sq_red_l = SquareStim(red, left, win)
-        sq_red_r = SquareStim(red, right, win)
-        sq_yel_l = SquareStim(yellow, left, win)
-        sq_yel_r = SquareStim(yellow, right, win)
+        sq_red_l = stimulus_cache.get(SquareStim, red, left, win)
+        sq_red_r = stimulus_cache.get(SquareStim, red, right, win)
+        sq_yel_l = stimulus_cache.get(SquareStim, yellow, left, win)
+        sq_yel_r = stimulus_cache.get(SquareStim, yellow, right, win)
 
         # Peripheral Landolts (No. 4, 5, 6, 7)
-        lt_dn_l = LandoltStim(down, left, win)
-        lt_dn_r = LandoltStim(down, right, win)
-        lt_up_l = LandoltStim(up, left, win)
-        lt_up_r = LandoltStim(up, right, win)
+        lt_dn_l = stimulus_cache.get(LandoltStim, down, left, win)
+        lt_dn_r = stimulus_cache.get(LandoltStim, down, right, win)
+        lt_up_l = stimulus_cache.get(LandoltStim, up, left, win)
+        lt_up_r = stimulus_cache.get(LandoltStim, up, right, win)
 
         self.central_stimuli = [sq_red_c, sq_yel_c, lt_dn_c, lt_up_c]
         self.peripheral_stimuli = [sq_red_l, sq_red_r, sq_yel_l, sq_yel_r,
                                    lt_dn_l, lt_dn_r, lt_up_l, lt_up_r]
 
+    def get_factors(self):
+        "Gets the factors of the design"
+        return Stimuli.FACTORS
+
+    def get_max_runs(self):
+        "Gets the maximum run lengths of the factors' levels"
+        return Stimuli.MAX_RUNS
+
+    def get_instructions(self):
+        "Gets the instruction text"
+        return Stimuli.INSTRUCTIONS
+
+    def prepare(self, levels):
+        """Prepares a trial of the cell with the given levels. Returns a
+        function that gets the central and the peripheral stimulus."""
+        stimulus, central, peripheral, side = levels
+        central_stim = self.central_stimuli[2 * stimulus + central]
+        peri_stim = self.peripheral_stimuli[4 * stimulus + 2 * peripheral +
+                                            side]
+        return lambda: (central_stim, peri_stim)
+
     def get_central_stimuli(self):
         "Returns a list of the 4 possible central stimuli"
         return self.central_stimuli
@@ -605,6 +2175,28 @@ class StimuliLandoltSmall:
     """Creates a container for the fixation cross,
     and the central an peripheral stimuli."""
 
+    # Factors of the design, see Stimuli
+    FACTORS = [("stimulus", ["square", "landolt", "landoltsmall"]),
+               ("central", [0, 1]),
+               ("peripheral", [0, 1]),
+               ("side", ["left", "right"])]
+    MAX_RUNS = {}
+
+    INSTRUCTIONS = """
+        Wenn die beiden Figuren gleich sind, druecken Sie mit dem
+        rechten Daumen, wenn Sie Rechtshaender sind und umgekehrt.
+        Wenn die beiden Figuren eine verschiedene Farbe haben,
+        oder eine unterschiedliche Orientierung, dann druecken
+        sie mit dem linken Daumen und umgekehrt.
+        Versuchen Sie, so schnell wie moeglich zu druecken, aber
+        wichtiger ist, dass Sie korrekte Antworten geben.
+
+        Wenn Sie bereit sind, druecken Sie dir rote Taste, um das
+        Experiment zu beginnen. Ansonsten fragen sie den
+        Versuchsleiter.
+
+        """
+
     def __init__(self, win, eyeheight):
 
         # Square colors
@@ -621,37 +2213,58 @@ class StimuliLandoltSmall:
         right = Position("right", eyeheight)
 
         # Fixation Cross
-        self.fix_cross = Point(win, central.get_fixcross_position())
+        self.fix_cross = stimulus_cache.get(Point, win, central.get_fixcross_position())
 
         # Central Stimuli (No. 0, 1, 2, 3, 4, 5)
-        sq_red_c = SquareStim(red, central, win)
-        sq_yel_c = SquareStim(yellow, central, win)
-        lt_dn_c = LandoltStim(down, central, win)
-        lt_up_c = LandoltStim(up, central, win)
-        ltsmall_dn_c = LandoltStimSmall(down, central, win) # extending with new type
-        ltsmall_up_c = LandoltStimSmall(up, central, win)
+        sq_red_c = stimulus_cache.get(SquareStim, red, central, win)
+        sq_yel_c = stimulus_cache.get(SquareStim, yellow, central, win)
+        lt_dn_c = stimulus_cache.get(LandoltStim, down, central, win)
+        lt_up_c = stimulus_cache.get(LandoltStim, up, central, win)
+        ltsmall_dn_c = stimulus_cache.get(LandoltStimSmall, down, central, win) # extending with new type
+        ltsmall_up_c = stimulus_cache.get(LandoltStimSmall, up, central, win)
 
         # Peripheral Squares (No. 0, 1, 2, 3)
-        sq_red_l = SquareStim(red, left, win)
-        sq_red_r = SquareStim(red, right, win)
-        sq_yel_l = SquareStim(yellow, left, win)
-        sq_yel_r = SquareStim(yellow, right, win)
+        sq_red_l = stimulus_cache.get(SquareStim, red, left, win)
+        sq_red_r = stimulus_cache.get(SquareStim, red, right, win)
+        sq_yel_l = stimulus_cache.get(SquareStim, yellow, left, win)
+        sq_yel_r = stimulus_cache.get(SquareStim, yellow, right, win)
 
         # Peripheral Landolts (No. 4, 5, 6, 7)
-        lt_dn_l = LandoltStim(down, left, win)
-        lt_dn_r = LandoltStim(down, right, win)
-        lt_up_l = LandoltStim(up, left, win)
-        lt_up_r = LandoltStim(up, right, win)
-        ltsmall_up_l = LandoltStimSmall(up, left, win)
-        ltsmall_up_r = LandoltStimSmall(up, right, win)
-        ltsmall_dn_l = LandoltStimSmall(down, left, win)
-        ltsmall_dn_r = LandoltStimSmall(down, right, win)
+        lt_dn_l = stimulus_cache.get(LandoltStim, down, left, win)
+        lt_dn_r = stimulus_cache.get(LandoltStim, down, right, win)
+        lt_up_l = stimulus_cache.get(LandoltStim, up, left, win)
+        lt_up_r = stimulus_cache.get(LandoltStim, up, right, win)
+        ltsmall_up_l = stimulus_cache.get(LandoltStimSmall, up, left, win)
+        ltsmall_up_r = stimulus_cache.get(LandoltStimSmall, up, right, win)
+        ltsmall_dn_l = stimulus_cache.get(LandoltStimSmall, down, left, win)
+        ltsmall_dn_r = stimulus_cache.get(LandoltStimSmall, down, right, win)
 
         self.central_stimuli = [sq_red_c, sq_yel_c, lt_dn_c, lt_up_c, ltsmall_dn_c, ltsmall_up_c]
         self.peripheral_stimuli = [sq_red_l, sq_red_r, sq_yel_l, sq_yel_r,
                                    lt_dn_l, lt_dn_r, lt_up_l, lt_up_r,
                                    ltsmall_dn_l, ltsmall_dn_r, ltsmall_up_l, ltsmall_up_r]
 
+    def get_factors(self):
+        "Gets the factors of the design"
+        return StimuliLandoltSmall.FACTORS
+
+    def get_max_runs(self):
+        "Gets the maximum run lengths of the factors' levels"
+        return StimuliLandoltSmall.MAX_RUNS
+
+    def get_instructions(self):
+        "Gets the instruction text"
+        return StimuliLandoltSmall.INSTRUCTIONS
+
+    def prepare(self, levels):
+        """Prepares a trial of the cell with the given levels. Returns a
+        function that gets the central and the peripheral stimulus."""
+        stimulus, central, peripheral, side = levels
+        central_stim = self.central_stimuli[2 * stimulus + central]
+        peri_stim = self.peripheral_stimuli[4 * stimulus + 2 * peripheral +
+                                            side]
+        return lambda: (central_stim, peri_stim)
+
     def get_central_stimuli(self):
         "Returns a list of the 6 possible central stimuli"
         return self.central_stimuli
@@ -668,7 +2281,35 @@ class StimuliSword:
     """Creates a container for the fixation cross,
     and the central an peripheral stimuli."""
 
+    # Factors of the design: the color or search task, the selected
+    # character and the four peripheral variants of each. The cells are
+    # numbered like the central stimuli and the peripheral design.
+    FACTORS = [("task", ["color", "search"]),
+               ("character", Sword.SELECTION),
+               ("variant", [0, 1, 2, 3])]
+    MAX_RUNS = {}
+
+    POOL_SIZE = 120 # Strings of the pool of a selected character (twice
+                    # as many in the pool without)
+
+    INSTRUCTIONS = """
+        Schauen sie immer zuerst auf den Punkt, danach auf die Figuren.
+        Sie muessen folgende 2 Aufgaben zu loesen:
+
+        1. Wenn die erste und zweite Figure uebereinstimmen, druecken
+        Sie "Ja" mit dem  Zeigefinger. Das ist der Fall, wenn die
+        erste und die zweite Figur die selbe Farbe aufweisen.
+        2. Bei weissen Figuren kommt es darauf an, ob die erste Figur
+        (ein Buchstabe) in der zweiten Figur (mehrere Buchstaben)
+        enthalten ist.
+        Versuchen Sie, so schnell wie moeglich zu druecken, aber
+        wichtiger ist, dass Sie korrekte Antworten geben. Wenn Sie
+        bereit sind, druecken Sie dir rote Taste, um das Experiment
+        zu beginnen. Ansonsten fragen sie den Versuchsleiter.
+        """
+
     def __init__(self, win, eyeheight):
+        self.win = win
 
         # Square colors
         red = Color("red")
@@ -681,78 +2322,133 @@ class StimuliSword:
         right = Position("right", eyeheight)
 
         # Fixation Cross
-        self.fix_cross = Point(win, central.get_fixcross_position())
+        self.fix_cross = stimulus_cache.get(Point, win, central.get_fixcross_position())
 
         # Central Stimuli
         self.central_stimuli = [
-                                SwordStim(red   , central, win, "i"),    # color task
-                                SwordStim(red   , central, win, "i"),
-                                SwordStim(yellow, central, win, "i"),
-                                SwordStim(yellow, central, win, "i"),
-                                SwordStim(red   , central, win, "o"),
-                                SwordStim(red   , central, win, "o"),
-                                SwordStim(yellow, central, win, "o"),
-                                SwordStim(yellow, central, win, "o"),
-                                SwordStim(red   , central, win, "x"),
-                                SwordStim(red   , central, win, "x"),
-                                SwordStim(yellow, central, win, "x"),
-                                SwordStim(yellow, central, win, "x"),
-                                SwordStim(red   , central, win, "v"),
-                                SwordStim(red   , central, win, "v"),
-                                SwordStim(yellow, central, win, "v"),
-                                SwordStim(yellow, central, win, "v"),
-                                SwordStim(white, central, win, "i"),    # search task
-                                SwordStim(white, central, win, "i"),
-                                SwordStim(white, central, win, "i"),
-                                SwordStim(white, central, win, "i"),
-                                SwordStim(white, central, win, "o"),
-                                SwordStim(white, central, win, "o"),
-                                SwordStim(white, central, win, "o"),
-                                SwordStim(white, central, win, "o"),
-                                SwordStim(white, central, win, "x"),
-                                SwordStim(white, central, win, "x"),
-                                SwordStim(white, central, win, "x"),
-                                SwordStim(white, central, win, "x"),
-                                SwordStim(white, central, win, "v"),
-                                SwordStim(white, central, win, "v"),
-                                SwordStim(white, central, win, "v"),
-                                SwordStim(white, central, win, "v")
+                                stimulus_cache.get(SwordStim, red,    central, win, "i"),    # color task
+                                stimulus_cache.get(SwordStim, red,    central, win, "i"),
+                                stimulus_cache.get(SwordStim, yellow, central, win, "i"),
+                                stimulus_cache.get(SwordStim, yellow, central, win, "i"),
+                                stimulus_cache.get(SwordStim, red,    central, win, "o"),
+                                stimulus_cache.get(SwordStim, red,    central, win, "o"),
+                                stimulus_cache.get(SwordStim, yellow, central, win, "o"),
+                                stimulus_cache.get(SwordStim, yellow, central, win, "o"),
+                                stimulus_cache.get(SwordStim, red,    central, win, "x"),
+                                stimulus_cache.get(SwordStim, red,    central, win, "x"),
+                                stimulus_cache.get(SwordStim, yellow, central, win, "x"),
+                                stimulus_cache.get(SwordStim, yellow, central, win, "x"),
+                                stimulus_cache.get(SwordStim, red,    central, win, "v"),
+                                stimulus_cache.get(SwordStim, red,    central, win, "v"),
+                                stimulus_cache.get(SwordStim, yellow, central, win, "v"),
+                                stimulus_cache.get(SwordStim, yellow, central, win, "v"),
+                                stimulus_cache.get(SwordStim, white, central, win, "i"),    # search task
+                                stimulus_cache.get(SwordStim, white, central, win, "i"),
+                                stimulus_cache.get(SwordStim, white, central, win, "i"),
+                                stimulus_cache.get(SwordStim, white, central, win, "i"),
+                                stimulus_cache.get(SwordStim, white, central, win, "o"),
+                                stimulus_cache.get(SwordStim, white, central, win, "o"),
+                                stimulus_cache.get(SwordStim, white, central, win, "o"),
+                                stimulus_cache.get(SwordStim, white, central, win, "o"),
+                                stimulus_cache.get(SwordStim, white, central, win, "x"),
+                                stimulus_cache.get(SwordStim, white, central, win, "x"),
+                                stimulus_cache.get(SwordStim, white, central, win, "x"),
+                                stimulus_cache.get(SwordStim, white, central, win, "x"),
+                                stimulus_cache.get(SwordStim, white, central, win, "v"),
+                                stimulus_cache.get(SwordStim, white, central, win, "v"),
+                                stimulus_cache.get(SwordStim, white, central, win, "v"),
+                                stimulus_cache.get(SwordStim, white, central, win, "v")
                                 ]
 
-        # initialize 32 random strings, 16 of them contain {a, c, o, u}
-        self.peripheral_stimuli = [SwordStim(red,    left , win, Sword("").string),      # color task
-                                   SwordStim(yellow, left , win, Sword("").string),      # no char matches because of
-                                   SwordStim(yellow, right , win, Sword("").string),     # subject confusion
-                                   SwordStim(red,    right , win, Sword("").string),
-                                   SwordStim(red,    left , win, Sword("").string),
-                                   SwordStim(yellow, left , win, Sword("").string),
-                                   SwordStim(yellow, right , win, Sword("").string),
-                                   SwordStim(red,    right , win, Sword("").string),
-                                   SwordStim(red,    left , win, Sword("").string),
-                                   SwordStim(yellow, left , win, Sword("").string),
-                                   SwordStim(yellow, right , win, Sword("").string),
-                                   SwordStim(red,    right , win, Sword("").string),
-                                   SwordStim(red,    left , win, Sword("").string),
-                                   SwordStim(yellow, left , win, Sword("").string),
-                                   SwordStim(yellow, right , win, Sword("").string),
-                                   SwordStim(red,    right , win, Sword("").string),
-                                   SwordStim(white, left , win, Sword("i").string),    # search task
-                                   SwordStim(white, right, win, Sword("i").string),
-                                   SwordStim(white, left , win, Sword("").string),
-                                   SwordStim(white, right, win, Sword("").string),
-                                   SwordStim(white, left , win, Sword("o").string),
-                                   SwordStim(white, right, win, Sword("o").string),
-                                   SwordStim(white, left , win, Sword("").string),
-                                   SwordStim(white, right, win, Sword("").string),
-                                   SwordStim(white, left , win, Sword("x").string),
-                                   SwordStim(white, right, win, Sword("x").string),
-                                   SwordStim(white, left , win, Sword("").string),
-                                   SwordStim(white, right, win, Sword("").string),
-                                   SwordStim(white, left , win, Sword("v").string),
-                                   SwordStim(white, right, win, Sword("v").string),
-                                   SwordStim(white, left , win, Sword("").string),
-                                   SwordStim(white, right, win, Sword("").string)
-                                   ]
+        # 32 random strings, 16 of them contain one of {i, o, x, v}. The
+        # peripheral stimuli are not cached, since new ones are created
+        # with create_peripheral_stimulus().
+        self.peripheral_design = [
+                                  (red, left, ""),             # color task
+                                  (yellow, left, ""),          # no char matches because of
+                                  (yellow, right, ""),         # subject confusion
+                                  (red, right, ""),
+                                  (red, left, ""),
+                                  (yellow, left, ""),
+                                  (yellow, right, ""),
+                                  (red, right, ""),
+                                  (red, left, ""),
+                                  (yellow, left, ""),
+                                  (yellow, right, ""),
+                                  (red, right, ""),
+                                  (red, left, ""),
+                                  (yellow, left, ""),
+                                  (yellow, right, ""),
+                                  (red, right, ""),
+                                  (white, left, "i"),          # search task
+                                  (white, right, "i"),
+                                  (white, left, ""),
+                                  (white, right, ""),
+                                  (white, left, "o"),
+                                  (white, right, "o"),
+                                  (white, left, ""),
+                                  (white, right, ""),
+                                  (white, left, "x"),
+                                  (white, right, "x"),
+                                  (white, left, ""),
+                                  (white, right, ""),
+                                  (white, left, "v"),
+                                  (white, right, "v"),
+                                  (white, left, ""),
+                                  (white, right, "")
+                                  ]
+
+        # The strings are taken from a pool of unique sWords for each
+        # selected character (and "" for none), generated at once
+        self.pools = {}
+        self.peripheral_stimuli = [self.create_peripheral_stimulus(
+                                       i, self.create_peripheral_string(i))
+                                   for i in range(0, len(
+                                       self.peripheral_design))]
+
+    def create_peripheral_string(self, i):
+        """Creates a new random string for the i-th peripheral stimulus,
+        that contains the same selected character (if any). The strings
+        of a pool are unique, a new pool is generated when it is used
+        up."""
+        match = self.peripheral_design[i][2]
+        if not self.pools.get(match):
+            if match == "":
+                corpus = SwordCorpus(StimuliSword.POOL_SIZE * 2, 0.0)
+            else:
+                corpus = SwordCorpus(StimuliSword.POOL_SIZE, 1.0, [match])
+            self.pools[match] = corpus.get_strings()
+        return self.pools[match].pop()
+
+    def create_peripheral_stimulus(self, i, text):
+        """Creates a new i-th peripheral stimulus showing the string."""
+        color, position, match = self.peripheral_design[i]
+        return SwordStim(color, position, self.win, text, match != "")
+
+    def get_factors(self):
+        "Gets the factors of the design"
+        return StimuliSword.FACTORS
+
+    def get_max_runs(self):
+        "Gets the maximum run lengths of the factors' levels"
+        return StimuliSword.MAX_RUNS
+
+    def get_instructions(self):
+        "Gets the instruction text"
+        return StimuliSword.INSTRUCTIONS
+
+    def prepare(self, levels):
+        """Prepares a trial of the cell with the given levels. Returns a
+        function that gets the central and the peripheral stimulus. Every
+        trial shows a new peripheral string, which is drawn here (in the
+        worker thread), its stimulus is built by the function (in the
+        presentation thread)."""
+        task, character, variant = levels
+        i = 16 * task + 4 * character + variant
+        central_stim = self.central_stimuli[i]
+        text = self.create_peripheral_string(i)
+        return lambda: (central_stim,
+                        self.create_peripheral_stimulus(i, text))
 
     def get_central_stimuli(self):
         "Returns a list of the 4 possible central stimuli"
@@ -766,496 +2462,630 @@ class StimuliSword:
         "Gets the fixation cross"
         return self.fix_cross
 
-class Session:
-    """The Session shows the instructions and
-    presents the blocks and trials."""
-
-    BBOX_ANSWER_MIDDLE = 0x58
-    KBOARD_SPACE = 'space'
-
-    PAUSE_DURATION = 20 # Pause durations in seconds
-
-    def __init__(self, input_device, handedness, screen, eyeheight,
-                 win_size, win_color, monitor, blocks, trials, clock):
-
-        self.input_device = input_device
-        self.handedness = handedness
-
-        Session.win_size = win_size
-        Session.win_color = win_color
-        Session.monitor = monitor
-
-        self.blocks = blocks
-        self.trials = trials
-        self.clock = clock
-
-        self.has_quit = False
-
-        # create window
-        self.win = visual.Window(size=Session.win_size,
-                                 monitor=Session.monitor,
-                                 units="deg",
-                                 color=Session.win_color,
-                                 screen=screen)
-        self.win.flip(clearBuffer = True)
-        # create stimuli
-        stimuli = Stimuli(self.win, eyeheight)
-        self.fix_cross = stimuli.get_fixation_cross()
-        self.c_stimuli = stimuli.get_central_stimuli()
-        self.p_stimuli = stimuli.get_peripheral_stimuli()
-        self.data = list()
+class StimuliMixed:
+    """Interleaves the trials of several stimulus sets, e.g. squares,
+    Landolts and sWords, in the blocks of one session. Its design has one
+    factor whose levels are the cells of all sets."""
+
+    def __init__(self, stimulus_sets, max_runs = {}):
+        self.stimulus_sets = stimulus_sets
+        self.max_runs = max_runs
+
+        # The sets come from the same stimulus cache, so they share the
+        # fixation cross and the stimuli they have in common
+        self.fix_cross = stimulus_sets[0].get_fixation_cross()
+        self.central_stimuli = []
+        self.peripheral_stimuli = []
+        self.conditions = []
+        names = []
+        for stimuli in stimulus_sets:
+            self.central_stimuli.extend(stimuli.get_central_stimuli())
+            self.peripheral_stimuli.extend(stimuli.get_peripheral_stimuli())
+            factors = stimuli.get_factors()
+            for levels in Design.cross(factors):
+                self.conditions.append((stimuli, levels))
+                names.append("%s %s" % (stimuli.__class__.__name__,
+                    "/".join([str(factors[i][1][level])
+                              for i, level in enumerate(levels)])))
+        self.factors = [("condition", names)]
+
+    def get_factors(self):
+        "Gets the factors of the design"
+        return self.factors
+
+    def get_max_runs(self):
+        "Gets the maximum run lengths of the factors' levels"
+        return self.max_runs
+
+    def get_instructions(self):
+        "Gets the instruction texts of all sets"
+        return "".join([stimuli.get_instructions()
+                        for stimuli in self.stimulus_sets])
+
+    def prepare(self, levels):
+        """Prepares a trial of the cell with the given levels."""
+        stimuli, levels = self.conditions[levels[0]]
+        return stimuli.prepare(levels)
 
-        # Randomization
-        # We have two stimuli matrices (central and peripheral).
-        # A random sequence is used to present the stimuli combinations.
-        # Number of trials should be a multiple of 16. The combination
-        # matrices are extended, e.g. by factor 2 if using 32 trials
-        self.cent_seq = [0, 0, 0, 0,
-                         1, 1, 1, 1,
-                         2, 2, 2, 2,
-                         3, 3, 3, 3] * (self.trials/16)
-        self.peri_seq = [0, 1, 2, 3,
-                         0, 1, 2, 3,
-                         4, 5, 6, 7,
-                         4, 5, 6, 7] * (self.trials/16)
-
-        self.rand_seq = range(0, self.trials)
-        random.shuffle(self.rand_seq) # block randomization
-        self.__show_instructions()
-        self.__run()
-
-    def __pause(self):
-        """Pause among the experimental blocks for relaxing times."""
-
-        pause_string = "Kurze Pause (20 Sekunden)"
-        ready_string = """
-                       Das Experiment geht nun weiter. Bitte druecken Sie
-                       die rote Taste, wenn Sie bereit sind.
-                       """
-
-        pause = visual.TextStim(self.win, text=pause_string,
-                                height=0.5, font='FreeSans')
-        ready = visual.TextStim(self.win, text=ready_string,
-                                height=0.5, font='FreeSans')
-
-        pause.draw()
-        self.win.flip(clearBuffer = True)
-        time.sleep(Session.PAUSE_DURATION)
-        ready.draw()
-        self.win.flip(clearBuffer = True)
-
-        event.clearEvents(eventType = None)
-        while True:
-            key = event.getKeys(keyList = Session.KBOARD_SPACE)
-            button = portio.inb(0x379)
-            if len(key) > 0 or button == Session.BBOX_ANSWER_MIDDLE:
-                self.win.flip(clearBuffer = True)
-                break
+    def get_central_stimuli(self):
+        "Returns a list of the central stimuli of all sets"
+        return self.central_stimuli
 
-    def __show_instructions(self):
+    def get_peripheral_stimuli(self):
+        "Returns a list of the peripheral stimuli of all sets"
+        return self.peripheral_stimuli
 
-        text = """
-        Wenn die beiden Figuren gleich sind, druecken Sie mit dem
-        Zeigefinger. Wenn die beiden Figuren eine verschiedene
-        Farbe haben, oder eine unterschiedliche Orientierung, dann
-        druecken sie mit dem Mittelfinger.
+    def get_fixation_cross(self):
+        "Gets the fixation cross"
+        return self.fix_cross
 
-        Versuchen Sie, so schnell wie moeglich zu druecken, aber
-        wichtiger ist, dass Sie korrekte Antworten geben.
+class StimuliQuest:
+    """Small Landolts for an adaptive threshold measurement. The size or
+    the exposure duration of the peripheral Landolt is chosen by QUEST
+    from the previous responses; the subject tells if the central and
+    the peripheral Landolt have the same orientation. The durations are
+    rounded to the frames of the frame timer, so QUEST is updated with
+    the exposure actually shown."""
+
+    FACTORS = [("central", ["down", "up"]),
+               ("peripheral", ["down", "up"]),
+               ("side", ["left", "right"])]
+    MAX_RUNS = {}
+    INSTRUCTIONS = StimuliLandoltSmall.INSTRUCTIONS
+
+    QUANTITIES = ["size", "duration"]
+    DURATION_GUESS = 0.2 # Guess of the duration threshold in seconds
+    GUESS_SD = 0.5 # Standard deviation of the prior in log10 units
+    TARGET = 0.75 # Proportion correct at the threshold
+
+    def __init__(self, win, eyeheight, quantity, frame_timer):
+        assert quantity in StimuliQuest.QUANTITIES
+        self.win = win
+        self.frame_timer = frame_timer
+        self.quantity = quantity
+        self.orientations = [Orientation("down"), Orientation("up")]
+        self.positions = [Position("left", eyeheight),
+                          Position("right", eyeheight)]
+        central = Position("central", eyeheight)
 
-        Wenn Sie bereit sind, druecken Sie dir rote Taste, um das
-        Experiment zu beginnen. Ansonsten fragen sie den
-        Versuchsleiter.
+        # Fixation Cross
+        self.fix_cross = stimulus_cache.get(Point, win, central.get_fixcross_position())
+
+        self.central_stimuli = [stimulus_cache.get(LandoltStimSmall,
+                                                   orientation, central, win)
+                                for orientation in self.orientations]
+        self.peripheral_stimuli = [stimulus_cache.get(LandoltStimSmall,
+                                                      orientation, position,
+                                                      win)
+                                   for orientation in self.orientations
+                                   for position in self.positions]
+
+        # The guess of the size is the small Landolt, the tested sizes and
+        # durations are at most the large Landolt and STIM_DUR
+        if quantity == "size":
+            guess = self.positions[0].get_landoltsmall_size()
+            self.max_intensity = math.log10(
+                self.positions[0].get_landolt_size())
+        else:
+            guess = StimuliQuest.DURATION_GUESS
+            self.max_intensity = math.log10(Trial.STIM_DUR)
+        self.quest = Quest(math.log10(guess), StimuliQuest.GUESS_SD,
+                           StimuliQuest.TARGET)
+        self.pending = None # Sameness and intensity of the last trial
+
+    def get_factors(self):
+        "Gets the factors of the design"
+        return StimuliQuest.FACTORS
+
+    def get_max_runs(self):
+        "Gets the maximum run lengths of the factors' levels"
+        return StimuliQuest.MAX_RUNS
+
+    def get_instructions(self):
+        "Gets the instruction text"
+        return StimuliQuest.INSTRUCTIONS
+
+    def prepare(self, levels):
+        """Prepares a trial of the cell with the given levels at the
+        intensity of QUEST. Must be called after the update with the
+        response of the previous trial."""
+        central, peripheral, side = levels
+        intensity = min(self.quest.get_intensity(), self.max_intensity)
+        if self.quantity == "duration":
+            frames = self.frame_timer.round_frames(10 ** intensity)
+            intensity = math.log10(float(frames) /
+                                   self.frame_timer.get_refresh_rate())
+        self.pending = (central == peripheral, intensity)
+        central_stim = self.central_stimuli[central]
+        if self.quantity == "size":
+            peri_stim = LandoltStimSmall(self.orientations[peripheral],
+                                         self.positions[side], self.win,
+                                         10 ** intensity)
+        else:
+            peri_stim = self.peripheral_stimuli[2 * peripheral + side]
+        return lambda: (central_stim, peri_stim)
+
+    def get_durations(self):
+        """Gets the durations of the timeline phases of the prepared trial
+        in seconds."""
+        if self.quantity == "duration":
+            return {"peripheral": 10 ** self.pending[1]}
+        return {}
+
+    def update(self, timer, handedness):
+        """Updates QUEST with the response of the prepared trial. The
+        answer "same" is the yes key or the button of the dominant hand.
+        Trials without response are not counted. The duration is the
+        measured exposure, which is longer than the planned one when
+        frames were dropped."""
+        assert handedness in ["right", "left"]
+        same, intensity = self.pending
+        response = timer[Trial.VAR_NAMES.index('response')]
+        if response == None:
+            return
+        if self.quantity == "duration":
+            intensity = math.log10(
+                timer[Trial.VAR_NAMES.index('peri_stim_off')] -
+                timer[Trial.VAR_NAMES.index('peri_stim_on')])
+        answer = (response == Trial.KBOARD_ANSWER_YES or
+                  response == "button_" + handedness)
+        duration = self.quest.update(intensity, answer == same)
+        log.info('QUEST %s %.3f: %s, threshold %.3f (sd %.3f log10), '
+                 'update %.3f ms', self.quantity, 10 ** intensity,
+                 answer == same and "correct" or "wrong",
+                 10 ** self.quest.get_mean(), self.quest.get_sd(),
+                 duration * 1000)
+
+    def report(self):
+        """Logs the threshold and the cost of the updates."""
+        mean, maximum = self.quest.get_update_times()
+        if mean == None:
+            return
+        log.info('QUEST %s threshold %.3f (sd %.3f log10) after %d trials, '
+                 'update mean %.3f ms, max %.3f ms', self.quantity,
+                 10 ** self.quest.get_mean(), self.quest.get_sd(),
+                 self.quest.trials, mean * 1000, maximum * 1000)
 
-        """
+    def get_central_stimuli(self):
+        "Returns a list of the 2 central stimuli"
+        return self.central_stimuli
 
-        text = """
-        Wenn die beiden Figuren gleich sind, druecken Sie mit dem linken Daumen.
+    def get_peripheral_stimuli(self):
+        "Returns a list of the 4 peripheral stimuli of the guessed size"
+        return self.peripheral_stimuli
 
-        """
+    def get_fixation_cross(self):
+        "Gets the fixation cross"
+        return self.fix_cross
 
-        instructions = visual.TextStim(self.win, text=text,
-                                       height=0.5, font='FreeSans')
-        instructions.draw()
-        self.win.flip(clearBuffer = True)
+class Design:
+    """A factorial design compiled into a trial plan. The factors (name
+    and list of levels) are fully crossed into cells, the first factor
+    varying slowest. Every block presents each cell equally often in its
+    own random order, optionally with a maximum run length of the same
+    level of a factor. The plan holds one cell number per trial in a
+    compact integer array, and is cached on disk by seed and design."""
 
-        event.clearEvents(eventType = None)
-        while True:
-            key = event.getKeys(keyList = Session.KBOARD_SPACE)
-            button = portio.inb(0x379)
-            if len(key) > 0 or button == Session.BBOX_ANSWER_MIDDLE:
-                self.win.flip(clearBuffer = True)
-                break
+    CACHE_DIR = os.path.join(os.path.expanduser("~"), ".pvrtask", "designs")
+    VERSION = 1 # Increase when the compiled plans change
+    ATTEMPTS = 1000 # Tries to build a block that meets the run lengths
 
-    def __run(self):
-        """Presents instructions, and all the trials in blocks"""
+    def __init__(self, factors, blocks, trials, seed = None, max_runs = {}):
+        self.factors = factors
+        self.blocks = blocks
+        self.trials = trials
+        self.max_runs = max_runs
+
+        self.levels = Design.cross(factors)
+        self.cells = len(self.levels)
+        assert self.cells < 0x10000, "Too many cells for the plan!"
+        self.runs = [(i, max_runs[name])
+                     for i, (name, levels) in enumerate(factors)
+                     if name in max_runs]
+
+        if trials % self.cells != 0:
+            log.warning('%d trials are not a multiple of the %d cells, '
+                        'the blocks are not balanced', trials, self.cells)
+
+        cached = seed != None
+        if seed == None:
+            seed = random.randrange(0, 0x7fffffff)
+        self.seed = seed
+        self.key = self.__get_key()
+
+        start = time.time()
+        self.plan = None
+        if cached:
+            self.plan = self.__load()
+        source = "loaded"
+        if self.plan == None:
+            self.plan = self.__compile()
+            source = "compiled"
+            if cached:
+                self.__save()
+        log.info('Design %s: %d cells, %d blocks of %d trials, seed %d, '
+                 '%s in %.3f ms', self.key[:8], self.cells, blocks, trials,
+                 seed, source, (time.time() - start) * 1000)
+
+    def cross(factors):
+        """Gets the level numbers of the factors of every cell, the first
+        factor varying slowest."""
+        cells = [()]
+        for name, levels in factors:
+            cells = [cell + (level,) for cell in cells
+                     for level in range(0, len(levels))]
+        return cells
+    cross = staticmethod(cross)
+
+    def __get_key(self):
+        """Gets the hash of the design and the seed."""
+        description = repr((Design.VERSION, self.factors, self.blocks,
+                            self.trials, sorted(self.max_runs.items()),
+                            self.seed))
+        return hashlib.sha1(description).hexdigest()
+
+    def __get_filename(self):
+        return os.path.join(Design.CACHE_DIR, self.key + ".plan")
+
+    def __load(self):
+        """Loads the plan from the cache, None if it is not cached."""
+        plan = array.array('H')
+        try:
+            file = open(self.__get_filename(), 'rb')
+            try:
+                plan.fromfile(file, self.blocks * self.trials)
+            finally:
+                file.close()
+        except (IOError, EOFError):
+            return None
+        return plan
 
-        trial_nr = 0 # we need this to count throughout the blocks
-        # block j, trial i
-        for j in range(0, self.blocks):
-            for i in range(0, self.trials):
-                if self.has_quit:
+    def __save(self):
+        """Writes the plan to the cache. The file is renamed into place,
+        so an interrupted write never leaves a broken plan."""
+        filename = self.__get_filename()
+        try:
+            if not os.path.isdir(Design.CACHE_DIR):
+                os.makedirs(Design.CACHE_DIR)
+            file = open(filename + ".tmp", 'wb')
+            self.plan.tofile(file)
+            file.close()
+            os.rename(filename + ".tmp", filename)
+        except (IOError, OSError), error:
+            log.warning('Design %s not cached: %s', self.key[:8], error)
+
+    def __compile(self):
+        """Builds the plan of all blocks with a random generator of its
+        own, so the plan only depends on the seed."""
+        generator = random.Random(self.seed)
+        plan = array.array('H')
+        for block in range(0, self.blocks):
+            # Complete repetitions of all cells, and the remaining trials
+            # drawn from the cells without replacement
+            counts = [self.trials / self.cells] * self.cells
+            for cell in generator.sample(range(0, self.cells),
+                                         self.trials % self.cells):
+                counts[cell] = counts[cell] + 1
+            plan.extend(self.__shuffle(generator, counts))
+        return plan
+
+    def __shuffle(self, generator, counts):
+        """Gets a random order of a block with the given number of trials
+        per cell. With run lengths, the next trial is drawn from the cells
+        that do not exceed them, and the block is started again in the
+        rare case that no cell is left."""
+        if not self.runs:
+            block = []
+            for cell in range(0, self.cells):
+                block.extend([cell] * counts[cell])
+            generator.shuffle(block)
+            return block
+
+        for attempt in range(0, Design.ATTEMPTS):
+            left = list(counts)
+            remaining = sum(left)
+            block = []
+            run = [0] * len(self.runs) # current run of each factor
+            while remaining > 0:
+                candidates = []
+                total = 0
+                for cell in range(0, self.cells):
+                    if left[cell] > 0 and not self.__exceeds(block, run,
+                                                             cell):
+                        candidates.append(cell)
+                        total = total + left[cell]
+                if total == 0:
                     break
-                trial = Trial(self.input_device,
-                              self.handedness,
-                              self.clock,
-                              trial_nr + 1,
-                              j + 1,
-                              self.fix_cross,
-                              self.c_stimuli[self.cent_seq[self.rand_seq[i]]],
-                              self.p_stimuli[self.peri_seq[self.rand_seq[i]]],
-                              self.win)
-                trial_nr = trial_nr + 1
-
-                # if quit key was pressed timer is 'None'
-                # and not written to data
-                if trial.get_timer() == None:
-                    self.has_quit = True
-                else:
-                    self.data.append(trial.get_timer())
-
-            # we don't make a pause in experiments with 1 block only,
-            # neither at the end of the last block.
-            if self.blocks > 1 and j < 2 and not self.has_quit:
-                self.__pause()
-
-        # Exit experiment
-        self.win.close()
-
-    def get_var_names(self):
-        """Gets the variable names."""
-        # This has to match the timer of the Trial object
-        return [['trial_nr',
-                 'block_nr',
-                 'trial_start',
-                 'central_stim_name',
-                 'central_stim_type',
-                 'central_stim_position',
-                 'peri_stim_name',
-                 'peri_stim_type',
-                 'peri_stim_position',
-                 'fixation_point_on',
-                 'center_stim_on',
-                 'peri_stim_on',
-                 'peri_stim_off',
-                 'response',
-                 'response_time']]
-
-    def get_data(self):
-        """Returns the data"""
-        return self.data
+                # Draw a cell weighted by its remaining trials
+                pick = generator.randrange(0, total)
+                for cell in candidates:
+                    pick = pick - left[cell]
+                    if pick < 0:
+                        break
+                self.__extend(block, run, cell)
+                left[cell] = left[cell] - 1
+                remaining = remaining - 1
+            if remaining == 0:
+                return block
+        raise ValueError('No block order with the maximum run lengths %s'
+                         % self.max_runs)
+
+    def __exceeds(self, block, run, cell):
+        """Checks if a cell would exceed a run length after the block."""
+        if not block:
+            return False
+        for r, (factor, max_run) in enumerate(self.runs):
+            if (self.levels[cell][factor] == self.levels[block[-1]][factor]
+                and run[r] >= max_run):
+                return True
+        return False
+
+    def __extend(self, block, run, cell):
+        """Appends a cell to the block and updates the runs."""
+        for r, (factor, max_run) in enumerate(self.runs):
+            if (block and self.levels[cell][factor] ==
+                self.levels[block[-1]][factor]):
+                run[r] = run[r] + 1
+            else:
+                run[r] = 1
+        block.append(cell)
+
+    def get_plan(self):
+        """Gets the cell numbers of all trials of all blocks."""
+        return self.plan
+
+    def get_cells(self):
+        """Gets the number of cells."""
+        return self.cells
+
+    def get_levels(self, cell):
+        """Gets the level numbers of the factors of a cell."""
+        return self.levels[cell]
+
+    def get_seed(self):
+        return self.seed
+
+class Quest:
+    """Bayesian adaptive staircase (QUEST, Watson & Pelli, 1983). The
+    posterior of the threshold is kept on a grid of log10 intensities
+    around the guess, with a Gaussian prior. After each response it is
+    multiplied with the likelihood of a Weibull psychometric function,
+    which is tabulated once for all differences of intensity and
+    threshold, so an update is one vectorized addition of log values. The
+    next intensity is the posterior mean."""
+
+    BETA = 3.5 # Slope of the Weibull function
+    DELTA = 0.01 # Rate of lapses
+    GRAIN = 0.01 # Step of the grid in log10 units
+    RANGE = 3.0 # Width of the grid in log10 units
+    MAX_UPDATE = 0.005 # Updates longer than this are logged as warning
+
+    def __init__(self, guess, guess_sd, target = 0.75, gamma = 0.5):
+        """The guess and its standard deviation are in log10 units, the
+        target is the proportion correct at the threshold and gamma the
+        proportion correct by chance."""
+        half = int(round(Quest.RANGE / 2 / Quest.GRAIN))
+        self.thresholds = guess + numpy.arange(-half, half + 1) * Quest.GRAIN
+        self.log_posterior = -0.5 * ((self.thresholds - guess) / guess_sd) ** 2
+
+        # Probability correct for intensity - threshold of k * GRAIN,
+        # k = -(n - 1)...(n - 1), shifted so that it is the target at the
+        # threshold
+        n = len(self.thresholds)
+        q = (target - Quest.DELTA * gamma) / (1 - Quest.DELTA)
+        shift = math.log10(-math.log((1 - q) / (1 - gamma))) / Quest.BETA
+        x = numpy.arange(-(n - 1), n) * Quest.GRAIN + shift
+        p = Quest.DELTA * gamma + (1 - Quest.DELTA) * \
+            (1 - (1 - gamma) * numpy.exp(-10 ** (Quest.BETA * x)))
+        self.log_likelihood = [numpy.log(1 - p), numpy.log(p)]
+
+        self.trials = 0
+        self.update_time = 0.0
+        self.max_update_time = 0.0
+
+    def __get_index(self, intensity):
+        """Gets the grid index of the intensity, limited to the grid."""
+        i = int(round((intensity - self.thresholds[0]) / Quest.GRAIN))
+        return min(max(i, 0), len(self.thresholds) - 1)
+
+    def update(self, intensity, correct):
+        """Adds the response to an intensity (log10) to the posterior, and
+        returns the duration of the update in seconds."""
+        start = time.time()
+        i = self.__get_index(intensity)
+        n = len(self.thresholds)
+        # For threshold j the likelihood is at k = i - j + n - 1
+        self.log_posterior += self.log_likelihood[int(bool(correct))][
+            i:i + n][::-1]
+        self.log_posterior -= self.log_posterior.max()
+        duration = time.time() - start
+
+        self.trials = self.trials + 1
+        self.update_time = self.update_time + duration
+        if duration > self.max_update_time:
+            self.max_update_time = duration
+        if duration > Quest.MAX_UPDATE:
+            log.warning('QUEST update took %.3f ms', duration * 1000)
+        return duration
+
+    def get_intensity(self):
+        """Gets the next intensity to test (log10), the posterior mean on
+        the grid."""
+        return float(self.thresholds[self.__get_index(self.get_mean())])
+
+    def get_mean(self):
+        """Gets the posterior mean of the threshold (log10)."""
+        posterior = numpy.exp(self.log_posterior)
+        return float(numpy.dot(posterior, self.thresholds) /
+                     posterior.sum())
+
+    def get_sd(self):
+        """Gets the posterior standard deviation of the threshold."""
+        posterior = numpy.exp(self.log_posterior)
+        mean = numpy.dot(posterior, self.thresholds) / posterior.sum()
+        return float(numpy.sqrt(numpy.dot(posterior,
+                                          (self.thresholds - mean) ** 2) /
+                                posterior.sum()))
+
+    def get_update_times(self):
+        """Gets the mean and maximum duration of an update in seconds."""
+        if self.trials == 0:
+            return [None, None]
+        return [self.update_time / self.trials, self.max_update_time]
 
-class SessionLandoltSmall:
+class Session:
     """The Session shows the instructions and
-    presents the blocks and trials. Adapded for Miriam"""
+    presents the blocks and trials. It runs the trials of any stimulus set
+    (Stimuli, StimuliLandoltSmall, StimuliSword or StimuliMixed), which
+    gives the factors of the design, the instructions and the stimuli of
+    each cell."""
 
-    BBOX_ANSWER_MIDDLE = 0x5f
+    BBOX_ANSWER_MIDDLE = 0x58
     KBOARD_SPACE = 'space'
 
     PAUSE_DURATION = 20 # Pause durations in seconds
 
-    def __init__(self, input_device, handedness, screen, eyeheight,
-                 win_size, win_color, monitor, blocks, trials, clock):
+    def __init__(self, input_device, handedness, window, frame_timer,
+                 stimuli, blocks, trials, clock, input_service,
+                 pulse_scheduler, realtime, seed = None,
+                 end_on_response = False):
 
         self.input_device = input_device
         self.handedness = handedness
 
-        Session.win_size = win_size
-        Session.win_color = win_color
-        Session.monitor = monitor
-
         self.blocks = blocks
         self.trials = trials
         self.clock = clock
+        self.input_service = input_service
+        self.pulse_scheduler = pulse_scheduler
+        self.waiter = DeadlineWaiter(clock)
+        self.realtime = realtime
+        self.phases = Trial.PHASES
+        if end_on_response:
+            self.phases = Trial.PHASES_END_ON_RESPONSE
 
         self.has_quit = False
 
-        # create window
-        self.win = visual.Window(size=Session.win_size,
-                                 monitor=Session.monitor,
-                                 units="deg",
-                                 color=Session.win_color,
-                                 screen=screen)
+        # The presentation window stays open after the session
+        self.win = window
         self.win.flip(clearBuffer = True)
-        # create stimuli
-        stimuli = StimuliLandoltSmall(self.win, eyeheight)
+        self.frame_timer = frame_timer
+        # The stimuli are created in the window by the caller
+        self.stimuli = stimuli
         self.fix_cross = stimuli.get_fixation_cross()
         self.c_stimuli = stimuli.get_central_stimuli()
         self.p_stimuli = stimuli.get_peripheral_stimuli()
+        self.__create_pause_screens()
         self.data = list()
 
         # Randomization
-        # We have two stimuli matrices (central and peripheral).
-        # A random sequence is used to present the stimuli combinations.
-        # Number of trials should be a multiple of 24. The combination
-        # matrices are extended, e.g. by factor 2 if using 32 trials
-        self.cent_seq = [0, 0, 0, 0,  # sq
-                         1, 1, 1, 1,
-                         2, 2, 2, 2,  # lt
-                         3, 3, 3, 3,
-                         4, 4, 4, 4,  # lt small
-                         5, 5, 5, 5 ] * (self.trials/24)
-        self.peri_seq = [0, 1, 2, 3, # sq
-                         0, 1, 2, 3,
-                         4, 5, 6, 7,
-                         4, 5, 6, 7,
-                         8, 9,10,11,
-                         8, 9,10,11 ] * (self.trials/24)
-
-        self.rand_seq = range(0, self.trials)
-        random.shuffle(self.rand_seq) # block randomization
+        # The design is compiled into a plan with a new random order in
+        # every block. A multiple of the number of cells presents every
+        # cell equally often.
+        self.design = Design(stimuli.get_factors(), blocks, trials, seed,
+                             stimuli.get_max_runs())
+        self.plan = self.design.get_plan()
         self.__show_instructions()
         self.__run()
 
-    def __pause(self):
-        """Pause among the experimental blocks for relaxing times."""
-
+    def __create_pause_screens(self):
+        """Creates the texts of the pause between the blocks."""
         pause_string = "Kurze Pause (20 Sekunden)"
         ready_string = """
                        Das Experiment geht nun weiter. Bitte druecken Sie
                        die rote Taste, wenn Sie bereit sind.
                        """
 
-        pause = visual.TextStim(self.win, text=pause_string,
-                                height=0.5, font='FreeSans')
-        ready = visual.TextStim(self.win, text=ready_string,
-                                height=0.5, font='FreeSans')
-
-        pause.draw()
-        self.win.flip(clearBuffer = True)
-        time.sleep(Session.PAUSE_DURATION)
-        ready.draw()
-        self.win.flip(clearBuffer = True)
-
-        event.clearEvents(eventType = None)
-        while True:
-            key = event.getKeys(keyList = Session.KBOARD_SPACE)
-            button = portio.inb(0x379)
-            if len(key) > 0 or button == Session.BBOX_ANSWER_MIDDLE:
-                self.win.flip(clearBuffer = True)
-                break
-
-    def __show_instructions(self):
-
-        text = """
-        Wenn die beiden Figuren gleich sind, druecken Sie mit dem
-        rechten Daumen, wenn Sie Rechtshaender sind und umgekehrt.
-        Wenn die beiden Figuren eine verschiedene Farbe haben,
-        oder eine unterschiedliche Orientierung, dann druecken
-        sie mit dem linken Daumen und umgekehrt.
-        Versuchen Sie, so schnell wie moeglich zu druecken, aber
-        wichtiger ist, dass Sie korrekte Antworten geben.
-
-        Wenn Sie bereit sind, druecken Sie dir rote Taste, um das
-        Experiment zu beginnen. Ansonsten fragen sie den
-        Versuchsleiter.
-
-        """
-        instructions = visual.TextStim(self.win, text=text,
-                                       height=0.5, font='FreeSans')
-        instructions.draw()
-        self.win.flip(clearBuffer = True)
-
-        event.clearEvents(eventType = None)
-        while True:
-            key = event.getKeys(keyList = Session.KBOARD_SPACE)
-            button = portio.inb(0x379)
-            if len(key) > 0 or button == Session.BBOX_ANSWER_MIDDLE:
-                self.win.flip(clearBuffer = True)
-                break
-
-    def __run(self):
-        """Presents instructions, and all the trials in blocks"""
-
-        trial_nr = 0 # we need this to count throughout the blocks
-        # block j, trial i
-        for j in range(0, self.blocks):
-            for i in range(0, self.trials):
-                if self.has_quit:
-                    break
-                trial = Trial(self.input_device,
-                              self.handedness,
-                              self.clock,
-                              trial_nr + 1,
-                              j + 1,
-                              self.fix_cross,
-                              self.c_stimuli[self.cent_seq[self.rand_seq[i]]],
-                              self.p_stimuli[self.peri_seq[self.rand_seq[i]]],
-                              self.win)
-                trial_nr = trial_nr + 1
-
-                # if quit key was pressed timer is 'None'
-                # and not written to data
-                if trial.get_timer() == None:
-                    self.has_quit = True
-                else:
-                    self.data.append(trial.get_timer())
-
-            # we don't make a pause in experiments with 1 block only,
-            # neither at the end of the last block.
-            if self.blocks > 1 and j < 2 and not self.has_quit:
-                self.__pause()
-
-        # Exit experiment
-        self.win.close()
-
-    def get_var_names(self):
-        """Gets the variable names."""
-        # This has to match the timer of the Trial object
-        return [['trial_nr',
-                 'block_nr',
-                 'trial_start',
-                 'central_stim_name',
-                 'central_stim_type',
-                 'central_stim_position',
-                 'peri_stim_name',
-                 'peri_stim_type',
-                 'peri_stim_position',
-                 'fixation_point_on',
-                 'center_stim_on',
-                 'peri_stim_on',
-                 'peri_stim_off',
-                 'response',
-                 'response_time']]
-
-    def get_data(self):
-        """Returns the data"""
-        return self.data
-
-class SessionSword:
-    """The Session shows the instructions and
-    presents the blocks and trials."""
-
-    BBOX_ANSWER_MIDDLE = 0x5f
-    KBOARD_SPACE = 'space'
-
-    PAUSE_DURATION = 20 # Pause durations in seconds
-
-    def __init__(self, input_device, handedness, screen, eyeheight,
-                 win_size, win_color, monitor, blocks, trials, clock):
-
-        self.input_device = input_device
-        self.handedness = handedness
-
-        Session.win_size = win_size
-        Session.win_color = win_color
-        Session.monitor = monitor
-
-        self.blocks = blocks
-        self.trials = trials
-        self.clock = clock
-
-        self.has_quit = False
-
-        # create window
-        self.win = visual.Window(size=Session.win_size,
-                                 monitor=Session.monitor,
-                                 units="deg",
-                                 color=Session.win_color,
-                                 screen=screen)
-        self.win.flip(clearBuffer = True)
-        # create stimuli
-        stimuli = StimuliSword(self.win, eyeheight)
-        self.fix_cross = stimuli.get_fixation_cross()
-        self.c_stimuli = stimuli.get_central_stimuli()
-        self.p_stimuli = stimuli.get_peripheral_stimuli()
-        self.data = list()
-
-        # Randomization
-        # We have two stimuli matrices (central and peripheral).
-        # A random sequence is used to present the stimuli combinations.
-        # Number of trials should be a multiple of 16. The combination
-        # matrices are extended, e.g. by factor 2 if using 32 trials
-        #self.cent_seq = [0, 1, 2, 3,   # color
-        #                 4, 5, 6, 7,   # color
-        #                 8, 9, 10, 11, # white
-        #                 12, 13, 14, 15] * (self.trials/16) # white
-        #self.peri_seq = [0, 1, 2, 3,
-        #                 0, 1, 2, 3,
-        #                 4, 5, 6, 7,
-        #                 4, 5, 6, 7] * (self.trials/16)
-
-        self.rand_seq = range(0, self.trials)
-        random.shuffle(self.rand_seq) # block randomization
-        self.__show_instructions()
-        self.__run()
+        self.pause_screen = visual.TextStim(self.win, text=pause_string,
+                                            height=0.5, font='FreeSans')
+        self.ready_screen = visual.TextStim(self.win, text=ready_string,
+                                            height=0.5, font='FreeSans')
 
     def __pause(self):
         """Pause among the experimental blocks for relaxing times."""
+        self.realtime.collect()
+        log.drain()
 
-        pause_string = "Kurze Pause (20 Sekunden)"
-        ready_string = """
-                       Das Experiment geht nun weiter. Bitte druecken Sie
-                       die rote Taste, wenn Sie bereit sind.
-                       """
-
-        pause = visual.TextStim(self.win, text=pause_string,
-                                height=0.5, font='FreeSans')
-        ready = visual.TextStim(self.win, text=ready_string,
-                                height=0.5, font='FreeSans')
-
-        pause.draw()
+        self.pause_screen.draw()
         self.win.flip(clearBuffer = True)
-        time.sleep(Session.PAUSE_DURATION)
-        ready.draw()
+        self.waiter.wait(Session.PAUSE_DURATION, "PAUSE_DURATION")
+        self.ready_screen.draw()
         self.win.flip(clearBuffer = True)
 
-        event.clearEvents(eventType = None)
-        while True:
-            key = event.getKeys(keyList = Session.KBOARD_SPACE)
-            button = portio.inb(0x379)
-            if len(key) > 0 or button == Session.BBOX_ANSWER_MIDDLE:
-                self.win.flip(clearBuffer = True)
-                break
+        self.input_service.wait_for_press([Session.BBOX_ANSWER_MIDDLE],
+                                          [Session.KBOARD_SPACE])
+        self.win.flip(clearBuffer = True)
 
     def __show_instructions(self):
-
-        text = """
-        Schauen sie immer zuerst auf den Punkt, danach auf die Figuren.
-        Sie muessen folgende 2 Aufgaben zu loesen:
-
-        1. Wenn die erste und zweite Figure uebereinstimmen, druecken
-        Sie "Ja" mit dem  Zeigefinger. Das ist der Fall, wenn die
-        erste und die zweite Figur die selbe Farbe aufweisen.
-        2. Bei weissen Figuren kommt es darauf an, ob die erste Figur
-        (ein Buchstabe) in der zweiten Figur (mehrere Buchstaben)
-        enthalten ist.
-        Versuchen Sie, so schnell wie moeglich zu druecken, aber
-        wichtiger ist, dass Sie korrekte Antworten geben. Wenn Sie
-        bereit sind, druecken Sie dir rote Taste, um das Experiment
-        zu beginnen. Ansonsten fragen sie den Versuchsleiter.
-        """
-        instructions = visual.TextStim(self.win, text=text,
+        """Shows the instructions of the stimulus set."""
+        instructions = visual.TextStim(self.win,
+                                       text=self.stimuli.get_instructions(),
                                        height=0.5, font='FreeSans')
         instructions.draw()
         self.win.flip(clearBuffer = True)
 
-        event.clearEvents(eventType = None)
-        while True:
-            key = event.getKeys(keyList = Session.KBOARD_SPACE)
-            button = portio.inb(0x379)
-            if len(key) > 0 or button == Session.BBOX_ANSWER_MIDDLE:
-                self.win.flip(clearBuffer = True)
-                break
+        self.input_service.wait_for_press([Session.BBOX_ANSWER_MIDDLE],
+                                          [Session.KBOARD_SPACE])
+        self.win.flip(clearBuffer = True)
+
+    def __prepare(self, n):
+        """Prepares the n-th trial of the session from its cell in the
+        plan."""
+        build = self.stimuli.prepare(self.design.get_levels(self.plan[n]))
+        return PreparedTrial(n + 1, lambda: (self.fix_cross,) + build())
 
     def __run(self):
         """Presents instructions, and all the trials in blocks"""
 
         trial_nr = 0 # we need this to count throughout the blocks
+
+        # Pay the first-draw costs of the stimuli and the pause screens
+        # before the first trial
+        self.frame_timer.warm_up([self.fix_cross] + self.c_stimuli +
+                                 self.p_stimuli + [self.pause_screen,
+                                                   self.ready_screen])
+
+        # The real-time mode only applies to this (the presentation)
+        # thread, the worker thread keeps the normal priority and the
+        # other CPUs. Adaptive stimulus sets choose each
+        # trial from the previous responses, their trials are prepared
+        # between the trials instead.
+        adaptive = hasattr(self.stimuli, 'update')
+        pipeline = None
+        if not adaptive:
+            pipeline = TrialPipeline(self.frame_timer, self.__prepare,
+                                     self.blocks * self.trials)
+            pipeline.start()
+        timeline = Timeline(self.phases, self.frame_timer,
+                            self.input_service, Trial.RESPONSE_PHASE,
+                            Trial.TTL_DURATION, self.design.get_seed())
+        self.realtime.enter()
         # block j, trial i
         for j in range(0, self.blocks):
             for i in range(0, self.trials):
                 if self.has_quit:
                     break
+                durations = {}
+                if adaptive:
+                    prepared = self.__prepare(trial_nr)
+                    durations = self.stimuli.get_durations()
+                else:
+                    prepared = pipeline.get()
+                fix_cross, central_stim, peri_stim = prepared.get_stimuli()
                 trial = Trial(self.input_device,
                               self.handedness,
                               self.clock,
                               trial_nr + 1,
                               j + 1,
-                              self.fix_cross,
-                              self.c_stimuli[self.rand_seq[i]],
-                              self.p_stimuli[self.rand_seq[i]],
-                              self.win)
+                              fix_cross,
+                              central_stim,
+                              peri_stim,
+                              self.win,
+                              self.frame_timer,
+                              self.input_service,
+                              self.pulse_scheduler,
+                              timeline,
+                              durations)
                 trial_nr = trial_nr + 1
 
                 # if quit key was pressed timer is 'None'
@@ -1264,6 +3094,9 @@ class SessionSword:
                     self.has_quit = True
                 else:
                     self.data.append(trial.get_timer())
+                    if adaptive:
+                        self.stimuli.update(trial.get_timer(),
+                                            self.handedness)
 
             # we don't make a pause in experiments with 1 block only,
             # neither at the end of the last block.
@@ -1271,26 +3104,25 @@ class SessionSword:
                 self.__pause()
 
         # Exit experiment
-        self.win.close()
+        self.realtime.leave()
+        if pipeline != None:
+            pipeline.stop()
+        self.win.flip(clearBuffer = True)
+        if adaptive:
+            self.stimuli.report()
+        self.waiter.report()
+        stimulus_cache.report()
+        resources.report()
+
+        # Only the data is kept after the session, the stimuli of the
+        # window stay in the cache for the next run
+        self.fix_cross = self.c_stimuli = self.p_stimuli = None
+        self.pause_screen = self.ready_screen = None
+        self.stimuli = self.frame_timer = self.win = None
 
     def get_var_names(self):
         """Gets the variable names."""
-        # This has to match the timer of the Trial object
-        return [['trial_nr',
-                 'block_nr',
-                 'trial_start',
-                 'central_stim_name',
-                 'central_stim_type',
-                 'central_stim_position',
-                 'peri_stim_name',
-                 'peri_stim_type',
-                 'peri_stim_position',
-                 'fixation_point_on',
-                 'center_stim_on',
-                 'peri_stim_on',
-                 'peri_stim_off',
-                 'response',
-                 'response_time']]
+        return [Trial.VAR_NAMES]
 
     def get_data(self):
         """Returns the data"""
@@ -1329,15 +3161,37 @@ class Experiment:
     PRACTICE_TRIALS = 24
     BLOCKS = 3
     TRIALS = 48
+    STAIRCASE_TRIALS = 40 # Trials of a threshold measurement (QUEST)
+    MIXED_REPEATS = 1 # Presentations of each cell per mixed block
     KBOARD_SPACE = 'space'
     KBOARD_TOGGLE = 't'
     KBOARD_QUIT = 'q'
     CALIBRATION_HEIGHT = 5.27 #120cm, if this is changed, resurvey calib. plane!
 
-    def __init__(self):
+    def __init__(self, port, realtime, keyboard_device, seed = None,
+                 end_on_response = False, keyboard_layout = "us"):
 
         # Start global clock
         self.clock = core.Clock()
+        self.realtime = realtime
+        self.seed = seed # Seed of the trial plans, None for a random one
+        # The peripheral stimulus ends on the response
+        self.end_on_response = end_on_response
+
+        # Start polling the response box
+        self.input_service = InputService(self.clock, port)
+        self.input_service.start()
+
+        # Read the keyboard from its event device, if one is given
+        if keyboard_device != None:
+            keyboard = EvdevKeyboard(self.clock, self.input_service,
+                                     keyboard_device, keyboard_layout)
+            self.input_service.set_keyboard(keyboard)
+            keyboard.start()
+
+        # Start the timer thread of the TTL pulses
+        self.pulse_scheduler = PulseScheduler(self.clock, port)
+        self.pulse_scheduler.start()
 
         self.id_generator = IDGenerator()
         self.motor_trials = None
@@ -1345,6 +3199,12 @@ class Experiment:
         self.practice_trials = None
         self.timer_head_calibration = None
 
+        # The presentation window, opened on first use and kept open
+        # for all runs
+        self.window = None
+        self.window_screen = None
+        self.frame_timer = None
+
         self.__init_gui()
 
     def __init_gui(self):
@@ -1365,7 +3225,7 @@ class Experiment:
         filemenu.add_command(label="Save As...", command=self.__save)
         filemenu.add_command(label="New Subject ID",
                              command=self.__new_id)
-        filemenu.add_command(label="Exit", command=exit_program)
+        filemenu.add_command(label="Exit", command=self.__exit)
 
         # # # Menu Display # # #
         displaymenu = Menu(menu)
@@ -1389,6 +3249,16 @@ class Experiment:
         #runmenu.add_command(label="Experiment Landolt", command=self.__start_experiment)
 
         runmenu.add_command(label="Experiment Small Landolt", command=self.__start_experiment_smallLandolt)
+        runmenu.add_command(label="Experiment Mixed",
+                            command=self.__start_experiment_mixed)
+        runmenu.add_command(label="Staircase Landolt Size",
+                            command=self.__start_staircase_size)
+        runmenu.add_command(label="Staircase Landolt Duration",
+                            command=self.__start_staircase_duration)
+
+        runmenu.add_separator()
+        runmenu.add_command(label="All Runs",
+                            command=self.__start_all_runs)
 
         #runmenu.add_separator()
 
@@ -1516,70 +3386,141 @@ class Experiment:
         """Copyright (C) 2010 Simon Schwab"""
         tkMessageBox.showinfo("About", string)
 
+    def __start_session(self, stimulus_set, blocks, trials,
+                        end_on_response = None):
+        """Runs a session with the stimulus set (a class taking the window
+        and the eye height, or a function) in the presentation window.
+        The peripheral stimulus ends on the response as given by the
+        option, unless end_on_response is given."""
+        if end_on_response == None:
+            end_on_response = self.end_on_response
+        window = self.__get_window()
+        stimuli = stimulus_set(window, self.spinbox_eyeheight.get())
+        return Session(self.inputdev.get(),
+                       self.hand.get(),
+                       window,
+                       self.frame_timer,
+                       stimuli,
+                       blocks,
+                       trials,
+                       self.clock,
+                       self.input_service,
+                       self.pulse_scheduler,
+                       self.realtime,
+                       self.seed,
+                       end_on_response)
+
     def __start_experiment(self):
         """Starts the experimental session"""
-        self.experimental_session = Session(self.inputdev.get(),
-                                     self.hand.get(),
-                                     self.__get_screen_no(),
-                                     self.spinbox_eyeheight.get(),
-                                     Experiment.WIN_SIZE,
-                                     Experiment.WIN_COLOR,
-                                     Experiment.MONITOR,
-                                     Experiment.BLOCKS,
-                                     Experiment.TRIALS,
-                                     self.clock)
+        self.experimental_session = self.__start_session(Stimuli,
+                                                         Experiment.BLOCKS,
+                                                         Experiment.TRIALS)
 
     def __start_experiment_sword(self):
         """Starts the experimental session"""
-        self.experimental_session = SessionSword(self.inputdev.get(),
-                                     self.hand.get(),
-                                     self.__get_screen_no(),
-                                     self.spinbox_eyeheight.get(),
-                                     Experiment.WIN_SIZE,
-                                     Experiment.WIN_COLOR,
-                                     Experiment.MONITOR,
-                                     Experiment.BLOCKS,
-                                     Experiment.TRIALS,
-                                     self.clock)
+        self.experimental_session = self.__start_session(StimuliSword,
+                                                         Experiment.BLOCKS,
+                                                         Experiment.TRIALS)
 
     def __start_experiment_smallLandolt(self):
         """Starts the experimental for Miriam"""
-        self.experimental_session = SessionLandoltSmall(self.inputdev.get(), # make custom session
-                                     self.hand.get(),
-                                     self.__get_screen_no(),
-                                     self.spinbox_eyeheight.get(),
-                                     Experiment.WIN_SIZE,
-                                     Experiment.WIN_COLOR,
-                                     Experiment.MONITOR,
-                                     Experiment.BLOCKS,
-                                     Experiment.TRIALS,
-                                     self.clock)
+        self.experimental_session = self.__start_session(StimuliLandoltSmall,
+                                                         Experiment.BLOCKS,
+                                                         Experiment.TRIALS)
+
+    def __start_experiment_mixed(self):
+        """Starts an experimental session with the trials of squares,
+        Landolts, small Landolts and sWords mixed in each block. A block
+        presents every cell of all sets MIXED_REPEATS times."""
+        stimulus_sets = [StimuliLandoltSmall, StimuliSword]
+        cells = sum([len(Design.cross(stimulus_set.FACTORS))
+                     for stimulus_set in stimulus_sets])
+        mixed = lambda window, eyeheight: StimuliMixed(
+            [stimulus_set(window, eyeheight)
+             for stimulus_set in stimulus_sets])
+        self.experimental_session = self.__start_session(
+            mixed, Experiment.BLOCKS, cells * Experiment.MIXED_REPEATS)
+
+    def __start_staircase(self, quantity):
+        """Measures the threshold of the size or the exposure duration of
+        the small peripheral Landolt with QUEST. The answer "same" is the
+        button of the dominant hand, so the handedness must be set. The
+        peripheral stimulus is always shown for the tested duration."""
+        if not self.hand.get() in ["right", "left"]:
+            log.error('Staircase not started: handedness is not set')
+            tkMessageBox.showinfo("Staircase",
+                                  "Please select the handedness first!")
+            return
+        staircase = lambda window, eyeheight: StimuliQuest(
+            window, eyeheight, quantity, self.frame_timer)
+        self.experimental_session = self.__start_session(
+            staircase, 1, Experiment.STAIRCASE_TRIALS, False)
+
+    def __start_staircase_size(self):
+        """Measures the size threshold"""
+        self.__start_staircase("size")
+
+    def __start_staircase_duration(self):
+        """Measures the exposure duration threshold"""
+        self.__start_staircase("duration")
 
     def __start_practice_trials(self):
         """An experimental session with fewer trials and blocks"""
-        self.practice_trials = SessionLandoltSmall(self.inputdev.get(),
-                                          self.hand.get(),
-                                          self.__get_screen_no(),
-                                          self.spinbox_eyeheight.get(),
-                                          Experiment.WIN_SIZE,
-                                          Experiment.WIN_COLOR,
-                                          Experiment.MONITOR,
-                                          Experiment.PRACTICE_BLOCKS,
-                                          Experiment.PRACTICE_TRIALS,
-                                          self.clock)
+        self.practice_trials = self.__start_session(StimuliLandoltSmall,
+                                                    Experiment.PRACTICE_BLOCKS,
+                                                    Experiment.PRACTICE_TRIALS)
 
     def __start_practice_trials_sword(self):
         """An experimental session with fewer trials and blocks"""
-        self.practice_trials = SessionSword(self.inputdev.get(),
-                                          self.hand.get(),
-                                          self.__get_screen_no(),
-                                          self.spinbox_eyeheight.get(),
-                                          Experiment.WIN_SIZE,
-                                          Experiment.WIN_COLOR,
-                                          Experiment.MONITOR,
-                                          Experiment.PRACTICE_BLOCKS,
-                                          Experiment.PRACTICE_TRIALS,
-                                          self.clock)
+        self.practice_trials = self.__start_session(StimuliSword,
+                                                    Experiment.PRACTICE_BLOCKS,
+                                                    Experiment.PRACTICE_TRIALS)
+
+    def __get_window(self):
+        """Gets the presentation window on the selected screen. The window
+        is opened once and reused by all runs, it is only opened again when
+        another screen is selected."""
+        screen = self.__get_screen_no()
+        if self.window != None and self.window_screen != screen:
+            resources.close_window(self.window)
+            self.window = None
+        if self.window == None:
+            self.window = resources.open_window(size=Experiment.WIN_SIZE,
+                                                monitor=Experiment.MONITOR,
+                                                units="deg",
+                                                color=Experiment.WIN_COLOR,
+                                                screen=screen)
+            self.window.flip(clearBuffer = True)
+            self.window_screen = screen
+            self.frame_timer = FrameTimer(self.window, self.clock,
+                                          self.pulse_scheduler)
+        return self.window
+
+    def __start_all_runs(self):
+        """Runs head and eye calibration, motor trials, practice trials
+        and the experiment one after the other on the presentation window,
+        with shared stimuli. Stops when a run is quit."""
+        log.info('All runs: head calibration')
+        self.__start_head_calibration()
+        log.info('All runs: eye calibration')
+        if not self.__start_eye_calibration():
+            return
+        log.info('All runs: motor trials')
+        self.__start_motor_trials()
+        if self.motor_trials.has_quit:
+            return
+        log.info('All runs: practice trials')
+        self.__start_practice_trials()
+        if self.practice_trials.has_quit:
+            return
+        log.info('All runs: experiment')
+        self.__start_experiment_smallLandolt()
+
+    def __exit(self):
+        """Closes the presentation window and exits."""
+        if self.window != None:
+            resources.close_window(self.window)
+        exit_program()
 
     def __get_screen_no(self):
         """Returns 0 Default Screen, 1 Secondary Screen (Beamer)"""
@@ -1673,68 +3614,54 @@ class Experiment:
         """Runs motor trials..."""
         self.motor_trials = MotorTrials(self.inputdev.get(),
                                         self.hand.get(),
-                                        self.__get_screen_no(),
+                                        self.__get_window(),
+                                        self.frame_timer,
                                         self.spinbox_eyeheight.get(),
-                                        Experiment.WIN_SIZE,
-                                        Experiment.WIN_COLOR,
-                                        Experiment.MONITOR,
-                                        self.clock)
+                                        self.clock,
+                                        self.input_service,
+                                        self.pulse_scheduler)
 
     def __start_head_calibration(self):
         """Shows head calibration screen. Uses a TTL Signal to mark head
         calibration in data file."""
         TTL_ON = 0x1
-        TTL_OFF = 0x0
-        win = visual.Window(size=Experiment.WIN_SIZE,
-                            monitor=Experiment.MONITOR,
-                            units="deg",
-                            color=Experiment.WIN_COLOR,
-                            screen=self.__get_screen_no())
+        TTL_DURATION = 2.0
+        win = self.__get_window()
         win.flip(clearBuffer = True)
 
         pos = Position("central", self.spinbox_eyeheight.get())
-        point_central = Point(win, pos.get_fixcross_position())
+        point_central = stimulus_cache.get(Point, win,
+                                           pos.get_fixcross_position())
 
         # Wait until space is pressed
-        while True:
-            key = event.getKeys(keyList = Experiment.KBOARD_SPACE)
-            if len(key) > 0:
-                break
+        self.input_service.wait_for_press([], [Experiment.KBOARD_SPACE])
 
         point_central.draw()
-        point_central.clearTextures()
         win.flip(clearBuffer = True)
-        portio.outb(TTL_ON, 0x378)
-        time_head_calibration_start = self.clock.getTime()
-        time.sleep(2)
-        portio.outb(TTL_OFF, 0x378)
-        time_head_calibration_end = self.clock.getTime()
-        self.timer_head_calibration = [time_head_calibration_start,
-                                       time_head_calibration_end]
-        win.close()
+        ttl = self.pulse_scheduler.pulse(TTL_ON, TTL_DURATION)
+
+        # The point stays on screen until the pulse is over
+        ttl.wait()
+        self.timer_head_calibration = ttl.get_times()
+        win.flip(clearBuffer = True)
 
     def __show_stimuli_screen(self):
         """Shows stimuli test screen."""
-        win = visual.Window(size=Experiment.WIN_SIZE,
-                            monitor=Experiment.MONITOR,
-                            units="deg",
-                            color=Experiment.WIN_COLOR,
-                            screen=self.__get_screen_no())
+        win = self.__get_window()
         win.flip(clearBuffer = True)
 
         pos = Position("central", self.spinbox_eyeheight.get())
-        point_central = Point(win, pos.get_fixcross_position())
-        point_left = Point(win, pos.get_left_position())
-        point_right = Point(win, pos.get_right_position())
 
         stimuli = StimuliLandoltSmall(win, self.spinbox_eyeheight.get())
         cent = stimuli.get_central_stimuli()
         peri = stimuli.get_peripheral_stimuli()
 
         # Squares
-        cent[0].draw()
-        peri[0].draw()
-        peri[1].draw()
+        squares = Batch(win)
+        squares.add_square_stim(cent[0])
+        squares.add_square_stim(peri[0])
+        squares.add_square_stim(peri[1])
+        squares.draw()
 
         #Landolts
         cent[2].draw()
@@ -1747,59 +3674,34 @@ class Experiment:
         peri[9].draw()
 
         # draw horizontal and vertical line for adjustment of
-        # the beamer to the screen.
-        vertical_vertices = [[0, -12], [0, 12]]
-        vertical_vertices_left = [[pos.get_left_position()[0], -12],
-                                  [pos.get_left_position()[0], 12]]
-        vertical_vertices_right = [[pos.get_right_position()[0], -12],
-                                   [pos.get_right_position()[0], 12]]
-
-        horizontal_vertices = [[-9, 0], [9, 0]]
-        vertical_line = visual.ShapeStim(win,
-                                         vertices=vertical_vertices,
-                                         pos=[0, 0])
-        vertical_line_left = visual.ShapeStim(win,
-                                              vertices=vertical_vertices_left,
-                                              pos=[0, 0])
-        vertical_line_right = visual.ShapeStim(win,
-                                               vertices=vertical_vertices_right,
-                                               pos=[0, 0])
-        horizontal_line = visual.ShapeStim(win,
-                                           vertices=horizontal_vertices,
-                                           pos=[0, 0])
-        vertical_line.draw()
-        vertical_line_left.draw()
-        vertical_line_right.draw()
-        horizontal_line.draw()
-
-        point_central.draw()
-        point_central.clearTextures()
-        point_left.draw()
-        point_left.clearTextures()
-        point_right.draw()
-        point_right.clearTextures()
+        # the beamer to the screen, and the points on top.
+        marks = Batch(win)
+        marks.add_line([0, -12], [0, 12])
+        marks.add_line([pos.get_left_position()[0], -12],
+                       [pos.get_left_position()[0], 12])
+        marks.add_line([pos.get_right_position()[0], -12],
+                       [pos.get_right_position()[0], 12])
+        marks.add_line([-9, 0], [9, 0])
+        marks.add_dot(pos.get_fixcross_position())
+        marks.add_dot(pos.get_left_position())
+        marks.add_dot(pos.get_right_position())
+        marks.draw()
 
         win.flip(clearBuffer = True)
 
         # Press any key to close testscreen
-        while True:
-            key = event.getKeys(keyList = Experiment.KBOARD_SPACE)
-            if len(key) > 0:
-                win.close()
-                break
+        self.input_service.wait_for_press([], [Experiment.KBOARD_SPACE])
+        win.flip(clearBuffer = True)
 
     def __start_eye_calibration(self):
-        """Shows eye calibration screen."""
+        """Shows eye calibration screen. Returns False if it was
+        cancelled."""
 
         # width = 5.0 # Width of calibration area 2x10 deg.
         width = 13.15 # Width of calibration area 2x25 deg.
 
         height = 3.75 # Height of calibration area 15 deg.
-        win = visual.Window(size=Experiment.WIN_SIZE,
-                            monitor=Experiment.MONITOR,
-                            units="deg",
-                            color=Experiment.WIN_COLOR,
-                            screen=self.__get_screen_no())
+        win = self.__get_window()
         win.flip(clearBuffer = True)
         # likewise to the fixationt cross, the calibration points
         # are displayed at the subject's eye height
@@ -1824,42 +3726,33 @@ class Experiment:
         points.append([p_0[0] + width/4, p_0[1] - height/4]) # Point 13
 
         # create fixation points f of points 1-13
+        batch = Batch(win)
         fixation_points = []
         for point in points:
-            fixation_points.append(Point(win, point))
-
-        for fixation_point in fixation_points:
-            fixation_point.draw()
+            fixation_points.append(batch.add_dot(point))
 
+        batch.draw()
         win.flip(clearBuffer = True)
 
         # Draw 13-point calibration screen, one after the other
         cancel = False
         for fixation_point in fixation_points:
-            if cancel:
-                break
-
-            while True:
-                key = event.getKeys(keyList = [Experiment.KBOARD_TOGGLE,
-                                               Experiment.KBOARD_QUIT])
-                if len(key) > 0:
-                    if key[0] == Experiment.KBOARD_QUIT:
-                        cancel = True
-                        break
-                    fixation_point.draw()
-                    win.flip(clearBuffer = True)
-                    break
-
-        for fixation_point in fixation_points:
-            fixation_point.clearTextures()
-
-        # Close window
-        while True:
-            key = event.getKeys(keyList = [Experiment.KBOARD_TOGGLE,
-                                           Experiment.KBOARD_QUIT])
-            if cancel or len(key) > 0:
-                win.close()
+            key = self.input_service.wait_for_press(
+                [], [Experiment.KBOARD_TOGGLE, Experiment.KBOARD_QUIT])
+            if key.code == Experiment.KBOARD_QUIT:
+                cancel = True
                 break
+            batch.set_all_visible(False)
+            batch.set_visible(fixation_point, True)
+            batch.draw()
+            win.flip(clearBuffer = True)
+
+        # Clear the screen
+        if not cancel:
+            self.input_service.wait_for_press(
+                [], [Experiment.KBOARD_TOGGLE, Experiment.KBOARD_QUIT])
+        win.flip(clearBuffer = True)
+        return not cancel
 
 class Point(visual.PatchStim):
     "Fixational point"
@@ -1871,12 +3764,142 @@ class Point(visual.PatchStim):
         visual.PatchStim.__init__(self, window, color=rgb, tex=None,
                                   mask='circle', size=Point.SIZE, pos=position)
 
+class Batch:
+    """Draws many simple primitives (dots, lines and squares) of a screen
+    with one call per kind. The vertices and colors of all elements of a
+    kind are packed into one array, and each element can have its own
+    color and be hidden or shown again without rebuilding the vertices.
+    Kinds are drawn in the order squares, lines, dots."""
+
+    SQUARES = 0
+    LINES = 1
+    DOTS = 2
+    MODES = [GL.GL_TRIANGLES, GL.GL_LINES, GL.GL_TRIANGLES]
+
+    DOT_SEGMENTS = 16 # Number of triangles of a dot
+
+    def __init__(self, window):
+        self.win = window
+        # Per kind: vertex list of each element, and its color
+        self.vertices = [[], [], []]
+        self.colors = [[], [], []]
+        self.visible = [[], [], []]
+        self.vertex_arrays = [None, None, None]
+        self.color_arrays = [None, None, None]
+
+    def __pix(self, value):
+        """Converts degrees into pixels."""
+        return misc.deg2pix(value, self.win.monitor)
+
+    def __add(self, kind, vertices, color):
+        """Adds an element and returns its handle."""
+        self.vertices[kind].append([self.__pix(v) for v in vertices])
+        self.colors[kind].append(color)
+        self.visible[kind].append(True)
+        self.vertex_arrays[kind] = None
+        self.color_arrays[kind] = None
+        return (kind, len(self.vertices[kind]) - 1)
+
+    def add_square(self, position, width, height, color = [1, 1, 1]):
+        """Adds a square anchored in its bottom left corner, like the
+        SquareStim."""
+        x, y = position
+        return self.__add(Batch.SQUARES,
+                          [x, y, x + width, y, x + width, y + height,
+                           x, y, x + width, y + height, x, y + height],
+                          color)
+
+    def add_square_stim(self, stimulus):
+        """Adds a square with the position, size and color of a
+        SquareStim."""
+        position = stimulus.position
+        return self.add_square(position.get_square_position(),
+                               position.get_square_width(),
+                               position.get_square_height(),
+                               stimulus.color.get_color())
+
+    def add_line(self, start, end, color = [1, 1, 1]):
+        """Adds a line between two points."""
+        return self.__add(Batch.LINES, list(start) + list(end), color)
+
+    def add_dot(self, position, size = None, color = [1, 1, 1]):
+        """Adds a round dot with the given diameter, by default the size
+        of the fixational Point."""
+        if size == None:
+            size = Point.SIZE
+        x, y = position
+        r = size / 2.0
+        vertices = []
+        for i in range(0, Batch.DOT_SEGMENTS):
+            a = 2 * math.pi * i / Batch.DOT_SEGMENTS
+            b = 2 * math.pi * (i + 1) / Batch.DOT_SEGMENTS
+            vertices.extend([x, y,
+                             x + r * math.cos(a), y + r * math.sin(a),
+                             x + r * math.cos(b), y + r * math.sin(b)])
+        return self.__add(Batch.DOTS, vertices, color)
+
+    def set_visible(self, element, visible):
+        """Shows or hides an element."""
+        kind, index = element
+        self.visible[kind][index] = visible
+        self.color_arrays[kind] = None
+
+    def set_all_visible(self, visible):
+        """Shows or hides all elements."""
+        for kind in [Batch.SQUARES, Batch.LINES, Batch.DOTS]:
+            self.visible[kind] = [visible] * len(self.visible[kind])
+            self.color_arrays[kind] = None
+
+    def set_color(self, element, color):
+        """Sets the color of an element."""
+        kind, index = element
+        self.colors[kind][index] = color
+        self.color_arrays[kind] = None
+
+    def __pack(self, kind):
+        """Packs the vertices and colors of a kind into the arrays. A
+        hidden element gets a fully transparent color."""
+        if self.vertex_arrays[kind] == None:
+            vertices = []
+            for element in self.vertices[kind]:
+                vertices.extend(element)
+            self.vertex_arrays[kind] = (GL.GLfloat * len(vertices))(*vertices)
+        if self.color_arrays[kind] == None:
+            colors = []
+            for element, color, visible in zip(self.vertices[kind],
+                                               self.colors[kind],
+                                               self.visible[kind]):
+                rgba = [(color[0] + 1) / 2.0, (color[1] + 1) / 2.0,
+                        (color[2] + 1) / 2.0, float(visible)]
+                colors.extend(rgba * (len(element) // 2))
+            self.color_arrays[kind] = (GL.GLfloat * len(colors))(*colors)
+
+    def draw(self, win = None):
+        """Draws all elements, with one call per kind."""
+        if win == None:
+            win = self.win
+        win.winHandle.switch_to()
+        win.setScale('pix')
+        GL.glDisable(GL.GL_TEXTURE_2D)
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glEnableClientState(GL.GL_COLOR_ARRAY)
+        for kind in [Batch.SQUARES, Batch.LINES, Batch.DOTS]:
+            if not self.vertices[kind]:
+                continue
+            self.__pack(kind)
+            GL.glVertexPointer(2, GL.GL_FLOAT, 0, self.vertex_arrays[kind])
+            GL.glColorPointer(4, GL.GL_FLOAT, 0, self.color_arrays[kind])
+            GL.glDrawArrays(Batch.MODES[kind], 0,
+                            len(self.vertex_arrays[kind]) // 2)
+        GL.glDisableClientState(GL.GL_COLOR_ARRAY)
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+
 class MotorTrials:
     """Motor Trials to test Subject's motoric skills"""
 
-    TTL_ON = 0x2
-    TTL_OFF = 0x0
+    TTL_ON = 0x2 # Data line of the trial marker
     TTL_DURATION = 0.050 # 50 ms is fine for 50Hz and 200Hz Tracking
+    RELEASE_TIMEOUT = 0.5 # Longest wait for the release of the response
     FIX_CROSS_DUR = 2.0
     STIM_DUR = 2.0
     KBOARD_ANSWER_LEFT = 'n'
@@ -1886,18 +3909,19 @@ class MotorTrials:
     # BBOX_ANSWER_MIDDLE = 0x5f
     BBOX_ANSWER_RIGHT = 0x6f
 
-    def __init__(self, input_device, handedness, screen, eyeheight,
-                 win_size, win_color, monitor, clock):
+    def __init__(self, input_device, handedness, window, frame_timer,
+                 eyeheight, clock, input_service, pulse_scheduler):
 
         self.input_device = input_device
         self.handedness = handedness
         self.clock = clock
-        self.win = visual.Window(size=win_size,
-                                 monitor=monitor,
-                                 units="deg",
-                                 color=win_color,
-                                 screen=screen)
+        self.input_service = input_service
+        self.pulse_scheduler = pulse_scheduler
+        self.waiter = DeadlineWaiter(clock)
+        self.has_quit = False
+        self.win = window
         self.win.flip(clearBuffer = True)
+        self.frame_timer = frame_timer
         # create stimuli
         stimuli = Stimuli(self.win, eyeheight)
         self.central_stimuli = stimuli.get_central_stimuli()
@@ -1933,83 +3957,105 @@ class MotorTrials:
         instructions.draw()
         self.win.flip(clearBuffer = True)
 
-        event.clearEvents(eventType = None)
-        while True:
-            key = event.getKeys(keyList = Session.KBOARD_SPACE)
-            button = portio.inb(0x379)
-            if len(key) > 0 or button == Session.BBOX_ANSWER_MIDDLE:
-                self.win.flip(clearBuffer = True)
-                break
+        self.input_service.wait_for_press([Session.BBOX_ANSWER_MIDDLE],
+                                          [Session.KBOARD_SPACE])
+        self.win.flip(clearBuffer = True)
 
     def __run(self):
 
         trial_nr = 1
 
+        # Pay the first-draw costs of the stimuli before the first trial
+        self.frame_timer.warm_up([self.fix_point] +
+                                 [self.central_stimuli[i]
+                                  for i in set(self.sequence)])
+
         for i in self.sequence:
 
             # Start of the trial
             trial_start = self.clock.getTime()
-            portio.outb(Trial.TTL_ON, 0x378)
-            time.sleep(Trial.TTL_DURATION)
-            portio.outb(Trial.TTL_OFF, 0x378)
+            self.frame_timer.start_recording()
 
-            # Fixation point
-            self.fix_point.draw()
-            self.win.flip(clearBuffer = True)
-            fix_cross_on = self.clock.getTime()
-            time.sleep(MotorTrials.FIX_CROSS_DUR)
+            # Durations in frames
+            fix_point_frames = self.frame_timer.get_frames(
+                MotorTrials.FIX_CROSS_DUR, "MotorTrials.FIX_CROSS_DUR")
+            stim_frames = self.frame_timer.get_frames(MotorTrials.STIM_DUR,
+                                                      "MotorTrials.STIM_DUR")
+
+            # Fixation point, the trial marker is sent on its flip
+            ttl = Pulse(MotorTrials.TTL_ON, MotorTrials.TTL_DURATION)
+            fix_cross_on = self.frame_timer.show([self.fix_point],
+                                                 fix_point_frames, ttl)
 
             # Stimulus
-            self.central_stimuli[i].draw()
-            self.win.flip(clearBuffer = True)
-            stimulus_on = self.clock.getTime()
+            frame = 0
             is_stim_on = True
 
+            # Answers of the selected input device. The quit key is
+            # always accepted.
+            if self.input_device == "Keyboard":
+                codes = []
+                keys = [MotorTrials.KBOARD_ANSWER_LEFT,
+                        MotorTrials.KBOARD_ANSWER_RIGHT,
+                        MotorTrials.KBOARD_ANSWER_QUIT]
+            elif self.input_device == "Response Box":
+                codes = [MotorTrials.BBOX_ANSWER_LEFT,
+                         MotorTrials.BBOX_ANSWER_RIGHT]
+                keys = [MotorTrials.KBOARD_ANSWER_QUIT]
+
             # Get user response
-            event.clearEvents(eventType = None)
+            self.input_service.clear()
             while True:
 
-                response_box = portio.inb(0x379)
-                response_keyb = event.getKeys(keyList =
-                                              [MotorTrials.KBOARD_ANSWER_LEFT,
-                                               MotorTrials.KBOARD_ANSWER_RIGHT,
-                                               MotorTrials.KBOARD_ANSWER_QUIT])
-
-                # Flip stimulus when stimulus duration is reached before
-                # subject response. This is perfomed only once using the
-                # boolean is_stim_on.
-                if (is_stim_on and
-                    self.clock.getTime() - stimulus_on >= MotorTrials.STIM_DUR):
-                    self.win.flip(clearBuffer = True)
-                    stimulus_off = self.clock.getTime()
-                    is_stim_on = False
-
-                # Get reaction time
-                if (response_box == MotorTrials.BBOX_ANSWER_LEFT or
-                    response_box == MotorTrials.BBOX_ANSWER_RIGHT or
-                    len(response_keyb) > 0):
-                    response_time = self.clock.getTime() - stimulus_on
+                # Flip stimulus when the number of stimulus frames is
+                # reached before subject response. This is perfomed only
+                # once using the boolean is_stim_on.
+                if is_stim_on:
+                    if frame < stim_frames:
+                        self.central_stimuli[i].draw()
+                    flip_time = self.frame_timer.flip()
+                    if frame == 0:
+                        stimulus_on = flip_time
+                    elif frame == stim_frames:
+                        stimulus_off = flip_time
+                        is_stim_on = False
+                    frame = frame + 1
+
+                # Get reaction time from the time stamp of the press
+                response_event = self.input_service.get_press(codes, keys)
+                if response_event != None:
+                    response_time = response_event.time - stimulus_on
                     break
 
-            # Flip stimulus when stimulus duration is reached
-            # after subject response
-            if is_stim_on:
-                while True:
-                    if (self.clock.getTime() -
-                        stimulus_on >= MotorTrials.STIM_DUR):
-                        self.win.flip(clearBuffer = True)
-                        stimulus_off = self.clock.getTime()
-                        break
+                # Without flips, sleep until the next event or keyboard poll
+                if not is_stim_on:
+                    self.input_service.wait(InputService.KEYBOARD_INTERVAL)
+
+            # Keep counting stimulus frames when the subject
+            # responded before the stimulus duration was reached
+            while is_stim_on:
+                if frame < stim_frames:
+                    self.central_stimuli[i].draw()
+                flip_time = self.frame_timer.flip()
+                if frame == stim_frames:
+                    stimulus_off = flip_time
+                    is_stim_on = False
+                frame = frame + 1
 
             # Check if the quit key was pressed
-            if (response_keyb != [] and
-                response_keyb[0] == MotorTrials.KBOARD_ANSWER_QUIT):
+            if response_event.code == MotorTrials.KBOARD_ANSWER_QUIT:
+                self.has_quit = True
                 break
 
-            if self.input_device == "Keyboard":
-                response = response_keyb[0] # We only take the first key pressed
-            elif  self.input_device == "Response Box":
-                response = response_box
+            # We only take the first key or button pressed. Its release is
+            # awaited before the next trial, if the device reports it.
+            response = response_event.code
+            response_up = None
+            if self.input_service.has_release(response_event):
+                response_release = self.input_service.wait_for_release(
+                    response, MotorTrials.RELEASE_TIMEOUT)
+                if response_release != None:
+                    response_up = response_release.time
 
             # Assign response box response
             if response == MotorTrials.BBOX_ANSWER_RIGHT:
@@ -2026,15 +4072,25 @@ class MotorTrials:
                      stimulus_on,
                      stimulus_off,
                      response,
-                     response_time]
+                     response_time] + ttl.get_times() + \
+                    [self.frame_timer.get_dropped_frames(),
+                     self.frame_timer.get_max_interval(),
+                     response_event.time,
+                     response_up]
 
-            print timer
+            log.info('%s', timer)
             self.data.append(timer)
 
             trial_nr = trial_nr + 1
 
-        self.fix_point.clearTextures()
-        self.win.close()
+        self.win.flip(clearBuffer = True)
+        self.waiter.report()
+        stimulus_cache.report()
+        resources.report()
+
+        # Only the data is kept after the trials
+        self.fix_point = self.central_stimuli = None
+        self.frame_timer = self.win = None
 
     def get_data(self):
         return self.data
@@ -2051,7 +4107,13 @@ class MotorTrials:
                  'stimulus_on',
                  'stimulus_off',
                  'response',
-                 'response_time']]
+                 'response_time',
+                 'ttl_on',
+                 'ttl_off',
+                 'dropped_frames',
+                 'max_frame_interval',
+                 'response_down',
+                 'response_up']]
 
 def check_root():
     """Check for root privileges"""
@@ -2060,22 +4122,87 @@ def check_root():
         time.sleep(2)
         sys.exit()
 
-def init_parport():
-    """Acquire permission for I/O on lp0"""
-    status_a = portio.ioperm(0x378, 1, 1)
-    status_b = portio.ioperm(0x379, 1, 1)
-    if status_a and status_b:
-        print 'ioperm 0x378:', os.strerror(status_a)
-        print 'ioperm 0x379:', os.strerror(status_b)
+def init_parport(backend, device):
+    """Opens the parallel port with the given backend ("portio",
+    "ppdev", "fake", or "auto" for the fastest available one), and
+    resets the data lines."""
+    if backend == "portio":
+        check_root()
+    try:
+        if backend == "auto":
+            port = parport.open_fastest()
+        else:
+            port = parport.open_port(backend, device)
+    except (ImportError, IOError, OSError, ValueError), error:
+        print 'Parallel port (%s): %s' % (backend, error)
         sys.exit()
 
-    portio.outb(0x0, 0x378)
+    port.measure_latency()
+    log.info('Parallel port: %s, %.2f us per call', port.name,
+             port.get_latency()[0] * 1e6)
+    port.write_data(0x0)
+    return port
+
+def parse_options():
+    """Parses the command line options."""
+    parser = optparse.OptionParser()
+    parser.add_option("--port", default="portio",
+                      choices=["portio", "ppdev", "fake", "auto"],
+                      help="parallel port backend: portio (default, needs "
+                      "root), ppdev, fake (no hardware), or auto")
+    parser.add_option("--device", default=None,
+                      help="base address (portio) or device file (ppdev) "
+                      "of the parallel port")
+    parser.add_option("--realtime", action="store_true", default=False,
+                      help="real-time priority and CPU affinity of the "
+                      "presentation thread, locked memory and no garbage "
+                      "collection during blocks")
+    parser.add_option("--cpu", type="int", default=None,
+                      help="CPU for the real-time mode (default: last)")
+    parser.add_option("--keyboard-device", default=None,
+                      help="read the keyboard with kernel time stamps from "
+                      "this event device, e.g. /dev/input/event3 (Linux)")
+    parser.add_option("--keyboard-layout", default="us",
+                      choices=["us", "qwertz"],
+                      help="layout of the keyboard of --keyboard-device: us "
+                      "(default) or qwertz (German and Swiss keyboards)")
+    parser.add_option("--seed", type="int", default=None,
+                      help="seed of the trial plans, to reproduce a "
+                      "session (default: random, see the log)")
+    parser.add_option("--end-on-response", action="store_true",
+                      default=False,
+                      help="end the peripheral stimulus when the subject "
+                      "responds, instead of showing it for STIM_DUR")
+    parser.add_option("--log-level", default="info",
+                      choices=["error", "warning", "info", "debug"],
+                      help="verbosity of the log (default: info, which "
+                      "includes the data of each trial)")
+    parser.add_option("--log-file", default=None,
+                      help="write the log to a file instead of stdout")
+    options, args = parser.parse_args()
+    return options
 
 def exit_program():
     """Program exit"""
+    log.stop()
     core.quit()
 
-# Run application
-check_root()
-init_parport()
-Experiment()
+def init_log(level, filename):
+    """Sets the verbosity and the output of the log, and starts
+    draining it in the background."""
+    stream = sys.stdout
+    if filename != None:
+        stream = open(filename, 'a')
+    log.set_output(stream, RingLog.LEVELS.index(level.upper()))
+    log.start()
+
+if __name__ == '__main__':
+    # Run application
+    options = parse_options()
+    init_log(options.log_level, options.log_file)
+    Experiment(init_parport(options.port, options.device),
+               RealtimeMode(options.realtime, options.cpu),
+               options.keyboard_device,
+               options.seed,
+               options.end_on_response,
+               options.keyboard_layout)
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+"""soak.py Long-run resource check for pvrtask by Simon Schwab"""
+# Copyright (C) 2010-2012 Simon Schwab
+# Department of Psychiatric Neurophysiology, University of Bern.
+#
+# Distributed under the terms of the GNU General Public License (GPL).
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs many simulated sessions in one process, like a day of subjects
+# in the same Tk program: each opens a window, builds and warms up the
+# stimuli of a session type, flips through a number of trials and
+# closes the window through the resource manager. The resident memory
+# and the live objects are printed regularly, and the run fails if the
+# memory keeps growing after the first sessions.
+#
+# $ python soak.py [--sessions 300] [--trials 16] [--tolerance 8]
+
+import sys, os, gc, random, optparse
+from psychopy import core
+
+import pvrtask
+from pvrtask import resources, Experiment, FrameTimer, Design, \
+                    Stimuli, StimuliLandoltSmall, StimuliSword
+
+SESSION_TYPES = [Stimuli, StimuliLandoltSmall, StimuliSword]
+WARMUP_SESSIONS = 10 # Sessions before the memory baseline is taken
+
+def get_memory():
+    """Gets the resident memory of the process in bytes (Linux)."""
+    statm = open('/proc/self/statm').read().split()
+    return int(statm[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def run_session(number, trials, clock):
+    """Simulates one session with a random type and eye height."""
+    win = resources.open_window(size=Experiment.WIN_SIZE,
+                                monitor=Experiment.MONITOR,
+                                units="deg",
+                                color=Experiment.WIN_COLOR,
+                                screen=0)
+    frame_timer = FrameTimer(win, clock, None)
+    kind = SESSION_TYPES[number % len(SESSION_TYPES)]
+    stimuli = kind(win, random.randint(150, 190))
+    fix_cross = stimuli.get_fixation_cross()
+    central = stimuli.get_central_stimuli()
+    peripheral = stimuli.get_peripheral_stimuli()
+    frame_timer.warm_up([fix_cross] + central + peripheral)
+
+    cells = Design.cross(stimuli.get_factors())
+    for trial in range(0, trials):
+        central_stim, peri_stim = stimuli.prepare(random.choice(cells))()
+        frame_timer.show([fix_cross], 2)
+        frame_timer.show([central_stim], 2)
+        frame_timer.show([peri_stim], 2)
+        frame_timer.flip()
+
+    resources.close_window(win)
+
+def count_live():
+    """Gets the number of live windows and GL objects."""
+    counts = resources.get_counts()
+    return sum([counts[kind][0] for kind in counts.keys()
+                if kind != 'glyph atlas'])
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sessions', type='int', default=300,
+                      help='number of simulated sessions')
+    parser.add_option('--trials', type='int', default=16,
+                      help='trials per session')
+    parser.add_option('--tolerance', type='float', default=8.0,
+                      help='accepted memory growth in MB after the first '
+                      '%d sessions' % WARMUP_SESSIONS)
+    (options, args) = parser.parse_args()
+
+    pvrtask.init_log('warning', None)
+    clock = core.Clock()
+    baseline = None
+    for number in range(0, options.sessions):
+        run_session(number, options.trials, clock)
+        gc.collect()
+        memory = get_memory()
+        if number + 1 == WARMUP_SESSIONS:
+            baseline = memory
+        if (number + 1) % 10 == 0:
+            print '%4d sessions: %6.1f MB, %6d objects, %d live resources' % (
+                number + 1, memory / 1e6, len(gc.get_objects()),
+                count_live())
+
+    pvrtask.log.stop()
+    counts = resources.get_counts()
+    for kind in counts.keys():
+        print '%s: %d live, %d bytes' % (kind, counts[kind][0],
+                                         counts[kind][1])
+    if baseline == None:
+        print 'Too few sessions for a memory baseline.'
+        return 0
+
+    growth = (get_memory() - baseline) / 1e6
+    print 'Memory growth after %d sessions: %.1f MB' % (WARMUP_SESSIONS,
+                                                       growth)
+    if count_live() != 0:
+        print 'FAILED: windows or GL objects are still alive.'
+        return 1
+    if growth > options.tolerance:
+        print 'FAILED: memory grew by more than %.1f MB.' % options.tolerance
+        return 1
+    print 'OK'
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
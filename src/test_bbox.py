@@ -17,18 +17,25 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import portio
+import sys, parport
+
+# Usage: test_bbox.py [portio|ppdev|fake] [base address or device file]
+backend = "portio"
+device = None
+if len(sys.argv) > 1:
+   backend = sys.argv[1]
+if len(sys.argv) > 2:
+   device = sys.argv[2]
 
 # init that stuff
-status_a = portio.ioperm(0x378, 1, 1)
-status_b = portio.ioperm(0x379, 1, 1)
-if status_a and status_b:
-   print 'ioperm 0x378:', os.strerror(status_a)
-   print 'ioperm 0x379:', os.strerror(status_b)
+try:
+   port = parport.open_port(backend, device)
+except (ImportError, IOError, OSError, ValueError), error:
+   print backend + ':', error
    sys.exit()
 
-portio.outb(0x0, 0x378)
+port.write_data(0x0)
 
 # output the button box to standard out
 while True:
-   print portio.inb(0x379)
+   print port.read_status()